@@ -0,0 +1,236 @@
+"""
+Audit log of issued registration links
+
+Set ``EMAIL_REGISTRATION_AUDIT_SINK`` to the dotted path of an audit sink to
+record which address received a link and when. The sink is instantiated
+once using the keyword arguments from ``EMAIL_REGISTRATION_AUDIT_OPTIONS``
+and has to provide a ``record(record)`` and a ``close()`` method.
+``record`` is called by ``send_registration_mail`` and the bulk paths for
+every mail and must not block.
+
+Records are ``AuditRecord`` tuples. The email address is only stored as a
+keyed hash (``hash_email``) so that the log answers whether a given address
+received a link without containing the addresses themselves.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime, timezone
+
+from django.apps import apps
+from django.db import close_old_connections
+from django.utils.crypto import salted_hmac
+
+from email_registration.conf import SettingInstance
+from email_registration.normalization import normalize_email
+
+
+logger = logging.getLogger(__name__)
+
+#: ``issued_at`` is the epoch at which the link was created, ``status`` is
+#: ``"sent"`` if the mail has been handed to the delivery backend (or the
+#: mail connection for bulk sends), ``"dropped"`` if the delivery backend
+#: discarded it and ``"failed"`` otherwise.
+AuditRecord = namedtuple("AuditRecord", "email_hash user_id issued_at status")
+
+
+def hash_email(email):
+    """
+    Returns the hash of the normalized ``email`` stored in audit records
+    """
+    return salted_hmac(
+        "email_registration.audit", normalize_email(email), algorithm="sha256"
+    ).hexdigest()[:32]
+
+
+class BufferedAuditSink:
+    """
+    Collects records in memory and writes them in batches from a background
+    thread
+
+    * ``batch_size``: Wakes up the thread as soon as this many records are
+      waiting.
+    * ``flush_interval``: Writes waiting records at least every this many
+      seconds.
+    * ``max_buffer``: Records arriving while this many are waiting already
+      are dropped (and counted in ``dropped``) instead of growing the
+      buffer without bounds when writing is slow or fails.
+
+    Subclasses implement ``write(records)``. Everything still waiting is
+    written by ``close()``, which happens automatically when the interpreter
+    shuts down. ``flush()`` writes synchronously in the calling thread.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=1, max_buffer=100000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def _start(self):
+        # Threads do not survive forking, e.g. with preloading servers
+        with self._lock:
+            if self._closed or (self._thread and self._pid == os.getpid()):
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._work, name="email-registration-audit", daemon=True
+            )
+            self._thread.start()
+
+    def _work(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            close_old_connections()
+
+    def record(self, record):
+        if self._thread is None or self._pid != os.getpid():
+            self._start()
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        self._buffer.append(record)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def flush(self):
+        """Writes all waiting records in the calling thread"""
+        while self._buffer:
+            records = []
+            while self._buffer and len(records) < self.batch_size:
+                records.append(self._buffer.popleft())
+            try:
+                self.write(records)
+            except Exception:
+                logger.exception("Writing %s audit records failed", len(records))
+
+    def write(self, records):
+        raise NotImplementedError
+
+    def close(self):
+        """Stops the background thread and writes everything still waiting"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self.flush()
+
+
+class FileAuditSink(BufferedAuditSink):
+    """
+    Appends records to the file ``path`` as JSON lines, one ``write`` per
+    batch::
+
+        {"email":"...","user":null,"issued":1700000000.0,"status":"sent"}
+    """
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def write(self, records):
+        data = "".join(
+            json.dumps(
+                {
+                    "email": record.email_hash,
+                    "user": record.user_id,
+                    "issued": record.issued_at,
+                    "status": record.status,
+                },
+                separators=(",", ":"),
+            )
+            + "\n"
+            for record in records
+        )
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+
+class ModelAuditSink(BufferedAuditSink):
+    """
+    Inserts records into the table of ``model`` (``"app_label.ModelName"``)
+    using ``bulk_create``
+
+    The model has to provide the fields ``email_hash`` (a ``CharField`` with
+    ``max_length=32``), ``user_id`` (nullable, matching the type of the
+    user model's primary key), ``issued_at`` (a ``DateTimeField``) and
+    ``status`` (a ``CharField``). This app does not ship a model so that
+    projects choose the database, indexes and retention themselves.
+    """
+
+    def __init__(self, model, **kwargs):
+        super().__init__(**kwargs)
+        self.model = model
+
+    def write(self, records):
+        model = apps.get_model(self.model)
+        model._default_manager.bulk_create(
+            [
+                model(
+                    email_hash=record.email_hash,
+                    user_id=record.user_id,
+                    issued_at=datetime.fromtimestamp(record.issued_at, timezone.utc),
+                    status=record.status,
+                )
+                for record in records
+            ],
+            batch_size=self.batch_size,
+        )
+
+
+_sink = SettingInstance(
+    "EMAIL_REGISTRATION_AUDIT_SINK", "EMAIL_REGISTRATION_AUDIT_OPTIONS", close=True
+)
+
+
+def get_audit_sink():
+    """
+    Returns the sink configured using ``EMAIL_REGISTRATION_AUDIT_SINK`` or
+    ``None``
+    """
+    return _sink.get()
+
+
+def record(email, user, status, issued_at=None):
+    """
+    Hands a record for the link sent to ``email`` to the audit sink, if one
+    is configured
+    """
+    sink = _sink.get()
+    if sink is not None:
+        sink.record(
+            AuditRecord(
+                hash_email(email),
+                user.pk if user is not None else None,
+                time.time() if issued_at is None else issued_at,
+                status,
+            )
+        )
+
+
+def flush():
+    """
+    Writes the records waiting in the audit sink if it buffers them, e.g.
+    in worker processes which exit without running ``atexit`` handlers
+    """
+    sink = _sink.get()
+    if sink is not None and hasattr(sink, "flush"):
+        sink.flush()
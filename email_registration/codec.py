@@ -0,0 +1,89 @@
+"""
+Encoding and decoding of the payload signed into registration links
+
+The payload is the email address for new users and
+``email!<uid>!<timestamp>`` for existing users, where the primary key (if
+it is an integer) and the ``last_login`` epoch are encoded in base 36.
+Domains never contain ``!`` so the fields can be split off unambiguously.
+
+Earlier releases used ``email:<uid>:<timestamp>`` payloads with a decimal
+primary key and a timestamp derived from ``strftime("%s")``. Those payloads
+are still accepted so that links sent before an upgrade keep working.
+"""
+
+import re
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.utils.http import base36_to_int, int_to_base36
+
+
+_legacy_payload = re.compile(r"^(.*):(\d*):([0-9a-z]*)$", re.S)
+_base36 = re.compile(r"^[0-9a-z]{1,13}$")
+
+
+def last_login_timestamp(user, legacy=False):
+    """
+    Returns the epoch of ``user.last_login`` or ``0`` if the user never
+    logged in
+
+    ``legacy=True`` returns the value used by earlier releases which
+    formatted the datetime using ``strftime("%s")``, ignoring its timezone.
+    """
+    last_login = user.last_login
+    if not last_login:
+        return 0
+    if legacy:
+        return int(last_login.strftime("%s"))
+    return int(last_login.timestamp())
+
+
+def dumps(email, user=None):
+    """
+    Returns the payload for ``email`` and the optional existing ``user``
+    """
+    if user is None:
+        return email
+    pk = user.pk
+    return "%s!%s!%s" % (
+        email,
+        int_to_base36(pk) if isinstance(pk, int) else "~%s" % pk,
+        int_to_base36(last_login_timestamp(user)),
+    )
+
+
+def loads(payload):
+    """
+    Returns a ``(email, pk, timestamp, legacy)`` tuple for ``payload``;
+    ``pk`` and ``timestamp`` are ``None`` for new users and ``legacy`` is
+    ``True`` for payloads issued by earlier releases
+
+    Raises ``ValueError`` if the payload cannot be decoded.
+    """
+    match = _legacy_payload.match(payload)
+    if match:
+        email, pk, timestamp = match.groups()
+        if pk and timestamp:
+            return email, pk, int(timestamp, 36), True
+        return email, None, None, True
+
+    local, at, domain = payload.rpartition("@")
+    if not at:
+        raise ValueError("Invalid payload %r" % payload)
+    domain, *fields = domain.split("!")
+    email = local + at + domain
+    if not fields:
+        try:
+            validate_email(email)
+        except ValidationError:
+            raise ValueError("Invalid payload %r" % payload)
+        return email, None, None, False
+
+    if len(fields) != 2 or not _base36.match(fields[1]):
+        raise ValueError("Invalid payload %r" % payload)
+    pk, timestamp = fields
+    if pk.startswith("~"):
+        pk = pk[1:]
+    else:
+        pk = base36_to_int(pk)
+    return email, pk, int(timestamp, 36), False
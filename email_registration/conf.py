@@ -0,0 +1,67 @@
+"""
+Helpers for loading the parts of this app which are configured in settings
+"""
+
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+
+def get_cache(alias=None):
+    """
+    Returns the cache ``alias`` or the cache used by this app,
+    ``EMAIL_REGISTRATION_CACHE`` or the default cache
+    """
+    return caches[alias or getattr(settings, "EMAIL_REGISTRATION_CACHE", "default")]
+
+
+class SettingInstance:
+    """
+    Instantiates the class configured using the dotted path in the setting
+    ``setting`` (or ``default``) once, passing the keyword arguments from
+    the setting ``options``
+
+    ``get()`` returns the instance or ``None`` if no class is configured.
+    The instance is discarded when either setting changes, e.g. in tests,
+    and its ``close()`` method is called first if ``close`` is set.
+    """
+
+    def __init__(self, setting, options, default=None, close=False):
+        self.setting = setting
+        self.options = options
+        self.default = default
+        self.close = close
+        self._instance = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        setting_changed.connect(self._setting_changed)
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    path = getattr(settings, self.setting, self.default)
+                    self._instance = (
+                        import_string(path)(**getattr(settings, self.options, {}))
+                        if path
+                        else None
+                    )
+                    self._loaded = True
+        return self._instance
+
+    def reset(self):
+        """
+        Discards (and closes) the current instance so that the next call to
+        ``get()`` instantiates a new one
+        """
+        with self._lock:
+            instance, self._instance, self._loaded = self._instance, None, False
+        if self.close and instance is not None:
+            instance.close()
+
+    def _setting_changed(self, setting, **kwargs):
+        if setting in {self.setting, self.options}:
+            self.reset()
@@ -0,0 +1,567 @@
+"""
+Delivery backends for registration mails
+
+``send_registration_mail`` renders the mail and hands the resulting message
+to the backend configured using ``EMAIL_REGISTRATION_DELIVERY_BACKEND``
+(a dotted path). The backend is instantiated once with the keyword arguments
+from ``EMAIL_REGISTRATION_DELIVERY_OPTIONS``. A backend only has to provide
+a ``deliver(message)`` and a ``close()`` method. ``deliver`` returns
+``False`` if the message has been discarded (any other return value means
+that the message has been sent or accepted for sending) and raises an
+exception if it could not be handed over.
+"""
+
+import atexit
+import base64
+import copy
+import json
+import logging
+import os
+import queue
+import secrets
+import socket
+import threading
+import time
+from email import message_from_bytes
+from email.generator import BytesGenerator
+from email.message import Message
+from email.utils import make_msgid
+from io import BytesIO
+
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.utils import DNS_NAME
+from django.utils.module_loading import import_string
+
+from email_registration.conf import SettingInstance
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class QueueFull(Exception):
+    """The delivery queue is full and the message could not be enqueued"""
+
+    pass
+
+
+class SyncDelivery:
+    """
+    Sends the message immediately in the calling thread. This is the default.
+    """
+
+    def deliver(self, message):
+        message.send()
+
+    def close(self):
+        pass
+
+
+class CallableDelivery:
+    """
+    Hands the message to an external task queue
+
+    * ``callable``: A callable or the dotted path to a callable which receives
+      the message instance, for example a function enqueuing a task which
+      ends up calling ``message.send()``.
+    """
+
+    def __init__(self, callable):
+        self.callable = (
+            import_string(callable) if isinstance(callable, str) else callable
+        )
+
+    def deliver(self, message):
+        self.callable(message)
+
+    def close(self):
+        pass
+
+
+class ThreadPoolDelivery:
+    """
+    Sends messages from a pool of background threads
+
+    * ``workers``: Number of worker threads. ``0`` starts no threads at all;
+      messages stay in the queue until ``drain()`` or ``close()`` is called,
+      which is mostly useful in tests.
+    * ``maxsize``: Maximum number of messages waiting in the queue.
+    * ``overflow``: What happens when the queue is full: ``"block"`` waits up
+      to ``timeout`` seconds for a free slot and raises ``QueueFull``
+      afterwards, ``"drop"`` discards the message (``deliver`` returns
+      ``False``) and ``"sync"`` sends the message in the calling thread.
+    * ``timeout``: See ``overflow``.
+
+    Messages still waiting in the queue are sent when ``close()`` is called,
+    which happens automatically when the interpreter shuts down.
+    """
+
+    def __init__(self, workers=2, maxsize=1000, overflow="block", timeout=5):
+        if overflow not in {"block", "drop", "sync"}:
+            raise ValueError("Unknown overflow policy %r" % overflow)
+        self.workers = workers
+        self.overflow = overflow
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.failed = 0
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+        atexit.register(self.close)
+
+    def _start(self):
+        with self._lock:
+            if self._threads or self._closed:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    name="email-registration-delivery-%s" % i,
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _send(self, message):
+        try:
+            message.send()
+        except Exception:
+            self.failed += 1
+            logger.exception("Sending a registration mail failed")
+
+    def _work(self):
+        while True:
+            message = self.queue.get()
+            try:
+                if message is _STOP:
+                    return
+                self._send(message)
+            finally:
+                self.queue.task_done()
+
+    def deliver(self, message):
+        if self._closed:
+            raise QueueFull("The delivery backend has been closed")
+        self._start()
+        try:
+            if self.overflow == "block":
+                self.queue.put(message, timeout=self.timeout)
+            else:
+                self.queue.put_nowait(message)
+        except queue.Full:
+            if self.overflow == "drop":
+                self.dropped += 1
+                logger.warning("Delivery queue full, dropping a registration mail")
+                return False
+            elif self.overflow == "sync":
+                message.send()
+            else:
+                raise QueueFull("Delivery queue full")
+
+    def qsize(self):
+        """Returns the approximate number of messages waiting in the queue"""
+        return self.queue.qsize()
+
+    def join(self):
+        """Waits until the workers have processed all enqueued messages"""
+        if self._threads:
+            self.queue.join()
+        else:
+            self.drain()
+
+    def drain(self):
+        """Sends all enqueued messages in the calling thread"""
+        while True:
+            try:
+                message = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                if message is not _STOP:
+                    self._send(message)
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """Stops accepting messages and sends everything still enqueued"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        for thread in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self.drain()
+
+
+class SpoolDelivery:
+    """
+    Appends messages to an on-disk spool instead of sending them, so that
+    registrations still succeed when the mail server is unavailable
+
+    Each process appends to its own segment file in ``directory``, one JSON
+    line per message. Full segments are sealed and sent by ``drain_spool``,
+    e.g. using ``./manage.py email_registration_drain_spool``.
+
+    * ``directory``: The spool directory, created if it does not exist.
+    * ``fsync_every``, ``fsync_interval``: Every write is flushed to the
+      operating system, but ``fsync`` only runs after this many messages or
+      when this many seconds have passed since the last ``fsync``.
+    * ``segment_size``, ``segment_age``: The current segment is sealed when
+      it exceeds this many bytes or when the first message is older than
+      this many seconds, also if no further message is written.
+    * ``drain_interval``: If set, a background thread drains the spool every
+      this many seconds.
+
+    Segments of processes which crashed before sealing them are picked up by
+    ``drain_spool`` as well.
+
+    Messages are spooled in their serialized form together with the sender
+    and the recipients. The mail backend used by ``drain_spool`` therefore
+    has to send ``message.message()``, as Django's SMTP backend does.
+    """
+
+    def __init__(
+        self,
+        directory,
+        fsync_every=10,
+        fsync_interval=1,
+        segment_size=1 << 20,
+        segment_age=10,
+        drain_interval=None,
+    ):
+        self.directory = directory
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+        self._closed = False
+        self._stop = threading.Event()
+        self._drainer = None
+        if drain_interval:
+            self._drainer = threading.Thread(
+                target=self._drain,
+                args=(drain_interval,),
+                name="email-registration-spool",
+                daemon=True,
+            )
+            self._drainer.start()
+        atexit.register(self.close)
+
+    def _open(self):
+        self._pid = os.getpid()
+        self._path = os.path.join(
+            self.directory,
+            "%s-%s-%s.active" % (_owner(), time.time_ns(), secrets.token_hex(4)),
+        )
+        self._file = open(self._path, "ab")
+        self._opened = self._synced = time.monotonic()
+        self._unsynced = 0
+        # Seal the segment when it expires even if no message follows
+        self._timer = threading.Timer(
+            self.segment_age, self._expire, args=(self._path,)
+        )
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire(self, path):
+        with self._lock:
+            if self._file is not None and self._path == path:
+                self._seal()
+
+    def _seal(self):
+        if self._file is None:
+            return
+        self._timer.cancel()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        os.rename(self._path, self._path[: -len(".active")] + ".spool")
+
+    def deliver(self, message):
+        if self._closed:
+            raise QueueFull("The delivery backend has been closed")
+        line = _dump_message(message)
+        with self._lock:
+            if self._file is not None and self._pid != os.getpid():
+                # Forked; the segment belongs to the parent process
+                self._file = None
+            if self._file is None:
+                self._open()
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced += 1
+            now = time.monotonic()
+            if (
+                self._file.tell() >= self.segment_size
+                or now - self._opened >= self.segment_age
+            ):
+                self._seal()
+            elif (
+                self._unsynced >= self.fsync_every
+                or now - self._synced >= self.fsync_interval
+            ):
+                os.fsync(self._file.fileno())
+                self._synced = now
+                self._unsynced = 0
+
+    def seal(self):
+        """Seals the current segment so that it can be drained"""
+        with self._lock:
+            if self._pid == os.getpid():
+                self._seal()
+
+    def _drain(self, interval):
+        while not self._stop.wait(interval):
+            self.seal()
+            try:
+                drain_spool(self.directory)
+            except Exception:
+                logger.exception("Draining the spool failed")
+
+    def close(self):
+        """Seals the current segment"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        self._stop.set()
+        if self._drainer is not None:
+            self._drainer.join()
+        with self._lock:
+            if self._pid == os.getpid():
+                self._seal()
+
+
+def _dump_message(message):
+    message = copy.copy(message)
+    message.connection = None
+    message.extra_headers = dict(message.extra_headers)
+    # The Message-ID is used to avoid sending the same message twice
+    message_id = message.extra_headers.setdefault(
+        "Message-ID", make_msgid(domain=DNS_NAME)
+    )
+    return (
+        json.dumps(
+            {
+                "id": message_id,
+                "from": message.from_email,
+                "to": message.recipients(),
+                "message": base64.b64encode(message.message().as_bytes()).decode(),
+            }
+        ).encode()
+        + b"\n"
+    )
+
+
+class _SpooledMIMEMessage(Message):
+    def as_bytes(self, unixfrom=False, linesep="\n"):
+        # The same signature as Django's MIME classes, used by the backends
+        fp = BytesIO()
+        BytesGenerator(fp, mangle_from_=False).flatten(
+            self, unixfrom=unixfrom, linesep=linesep
+        )
+        return fp.getvalue()
+
+
+class SpooledMessage(EmailMessage):
+    """
+    A message read from the spool; ``message()`` returns the message as it
+    was serialized when spooling it
+    """
+
+    def __init__(self, data, from_email, recipients, message_id):
+        super().__init__(
+            from_email=from_email,
+            to=recipients,
+            headers={"Message-ID": message_id},
+        )
+        self.data = data
+
+    def message(self):
+        return message_from_bytes(self.data, _class=_SpooledMIMEMessage)
+
+
+def _owner():
+    # Segments and claims are named after the host and process owning them
+    return "%s-%s" % (socket.gethostname().replace(".", "_"), os.getpid())
+
+
+def _is_orphaned(owner):
+    host, _, pid = owner.rpartition("-")
+    if host != socket.gethostname().replace(".", "_"):
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (OSError, ValueError):
+        return False
+    return False
+
+
+def _claim_segments(directory):
+    owner = _owner()
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith(".spool"):
+            pass
+        elif name.endswith(".active"):
+            if not _is_orphaned(name[: -len(".active")].rsplit("-", 2)[0]):
+                continue
+        elif name.endswith(".draining"):
+            if not _is_orphaned(name[: -len(".draining")].rpartition(".")[2]):
+                continue
+        else:
+            continue
+        segment = name.partition(".")[0]
+        claimed = os.path.join(directory, "%s.%s.draining" % (segment, owner))
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            continue  # Claimed by a different process
+        yield segment, claimed
+
+
+def _read_segment(path):
+    with open(path, "rb") as f:
+        for number, line in enumerate(f, 1):
+            try:
+                record = json.loads(line)
+                yield record["id"], SpooledMessage(
+                    base64.b64decode(record["message"]),
+                    record["from"],
+                    record["to"],
+                    record["id"],
+                )
+            except Exception:
+                # E.g. the last line of a segment if the process crashed
+                # while writing it
+                logger.warning("Skipping invalid line %s of %s", number, path)
+
+
+def drain_spool(
+    directory,
+    batch_size=100,
+    retries=5,
+    backoff=1,
+    max_backoff=60,
+    connection=None,
+    sleep=time.sleep,
+):
+    """
+    Sends the messages of all sealed (and orphaned) segments in
+    ``directory`` in batches of ``batch_size`` messages using a single mail
+    connection and returns the number of sent messages
+
+    Failed batches (including opening the connection) are retried
+    ``retries`` times, waiting ``backoff`` seconds before the first retry
+    and twice as long before each following retry (up to ``max_backoff``
+    seconds). If a batch still fails the
+    segment is released again and ``drain_spool`` raises the last
+    exception; the message IDs of all sent messages are recorded in a
+    ``.sent`` file next to the segment so that they are not sent again.
+    """
+    sent = 0
+    seen = set()
+    connection = connection or get_connection()
+    try:
+        for segment, path in _claim_segments(directory):
+            progress = os.path.join(directory, "%s.sent" % segment)
+            if os.path.exists(progress):
+                with open(progress) as f:
+                    seen.update(f.read().split())
+
+            with open(progress, "a") as log:
+                batch = []
+                try:
+                    for message_id, message in _read_segment(path):
+                        if message_id in seen:
+                            continue
+                        seen.add(message_id)
+                        batch.append((message_id, message))
+                        if len(batch) >= batch_size:
+                            sent += _send_batch(
+                                connection,
+                                batch,
+                                log,
+                                retries,
+                                backoff,
+                                max_backoff,
+                                sleep,
+                            )
+                            batch = []
+                    if batch:
+                        sent += _send_batch(
+                            connection, batch, log, retries, backoff, max_backoff, sleep
+                        )
+                except Exception:
+                    os.rename(path, os.path.join(directory, "%s.spool" % segment))
+                    raise
+
+            os.remove(path)
+            os.remove(progress)
+    finally:
+        connection.close()
+    return sent
+
+
+def _send_batch(connection, batch, log, retries, backoff, max_backoff, sleep):
+    position = 0
+    for attempt in range(retries + 1):
+        try:
+            # Does nothing if the connection is open already
+            connection.open()
+            while position < len(batch):
+                message_id, message = batch[position]
+                connection.send_messages([message])
+                log.write("%s\n" % message_id)
+                position += 1
+            return position
+        except Exception:
+            if attempt == retries:
+                raise
+            logger.warning("Sending spooled mails failed, retrying", exc_info=True)
+            sleep(min(backoff * 2**attempt, max_backoff))
+            try:
+                connection.close()
+            except Exception:
+                pass  # The connection is unusable anyway
+        finally:
+            log.flush()
+            os.fsync(log.fileno())
+
+
+_backend = SettingInstance(
+    "EMAIL_REGISTRATION_DELIVERY_BACKEND",
+    "EMAIL_REGISTRATION_DELIVERY_OPTIONS",
+    default="email_registration.delivery.SyncDelivery",
+    close=True,
+)
+
+
+def get_delivery_backend():
+    """
+    Returns the delivery backend instance configured using
+    ``EMAIL_REGISTRATION_DELIVERY_BACKEND`` and
+    ``EMAIL_REGISTRATION_DELIVERY_OPTIONS``
+    """
+    return _backend.get()
+
+
+def reset_delivery_backend():
+    """
+    Closes the current delivery backend (sending all pending messages) so
+    that the next call to ``get_delivery_backend`` instantiates a new one
+    """
+    _backend.reset()
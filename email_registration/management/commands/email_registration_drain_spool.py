@@ -0,0 +1,65 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from email_registration.delivery import drain_spool
+
+
+class Command(BaseCommand):
+    help = "Sends the registration mails spooled by SpoolDelivery."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--directory",
+            help="The spool directory. Defaults to the directory option of"
+            " EMAIL_REGISTRATION_DELIVERY_OPTIONS.",
+        )
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--retries",
+            type=int,
+            default=5,
+            help="Number of retries of a failed batch.",
+        )
+        parser.add_argument(
+            "--backoff",
+            type=float,
+            default=1,
+            help="Seconds to wait before the first retry, doubled for each"
+            " following retry.",
+        )
+        parser.add_argument("--max-backoff", type=float, default=60)
+        parser.add_argument(
+            "--loop",
+            type=float,
+            metavar="SECONDS",
+            help="Keep running and drain the spool every SECONDS seconds.",
+        )
+
+    def handle(self, directory, loop, **options):
+        directory = directory or getattr(
+            settings, "EMAIL_REGISTRATION_DELIVERY_OPTIONS", {}
+        ).get("directory")
+        if not directory:
+            raise CommandError("No spool directory configured.")
+
+        while True:
+            try:
+                sent = drain_spool(
+                    directory,
+                    batch_size=options["batch_size"],
+                    retries=options["retries"],
+                    backoff=options["backoff"],
+                    max_backoff=options["max_backoff"],
+                )
+            except Exception as exc:
+                if not loop:
+                    raise CommandError("Draining the spool failed: %s" % exc)
+                self.stderr.write("Draining the spool failed: %s" % exc)
+            else:
+                if options["verbosity"]:
+                    self.stdout.write("Sent %s spooled mails." % sent)
+            if not loop:
+                return
+            time.sleep(loop)
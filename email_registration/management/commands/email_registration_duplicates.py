@@ -0,0 +1,56 @@
+import hashlib
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from email_registration.normalization import normalize_email
+
+
+def _digest(value):
+    return hashlib.blake2b(value.encode(), digest_size=8).digest()
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports users whose email addresses are equal after normalization."
+        " Prints tab separated lines of the normalized address, the primary"
+        " key and the stored address."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--normalize",
+            metavar="PATH",
+            help="Dotted path of the normalization function to use instead of"
+            " EMAIL_REGISTRATION_NORMALIZE_EMAIL.",
+        )
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, normalize, chunk_size, **options):
+        normalize = import_string(normalize) if normalize else normalize_email
+        User = get_user_model()
+        queryset = (
+            User._default_manager.exclude(email="")
+            .order_by()
+            .values_list("pk", "email")
+        )
+
+        # Two passes over the table so that only an 8 byte digest per row is
+        # kept in memory instead of all addresses.
+        counts = Counter(
+            _digest(normalize(email))
+            for pk, email in queryset.iterator(chunk_size=chunk_size)
+        )
+        duplicates = {digest for digest, count in counts.items() if count > 1}
+        del counts
+
+        found = 0
+        for pk, email in queryset.iterator(chunk_size=chunk_size):
+            normalized = normalize(email)
+            if _digest(normalized) in duplicates:
+                found += 1
+                self.stdout.write("%s\t%s\t%s" % (normalized, pk, email))
+
+        self.stderr.write("%s rows with duplicate email addresses." % found)
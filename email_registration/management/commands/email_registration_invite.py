@@ -0,0 +1,266 @@
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import validate_email
+from django.db import connections
+
+from email_registration import audit
+from email_registration.normalization import normalize_email
+from email_registration.utils import (
+    get_base_url,
+    get_user_model_info,
+    send_registration_mails,
+)
+
+
+_connection = None
+_worker = False
+
+
+def _init_worker():
+    # Worker processes keep one mail connection open for all chunks.
+    global _connection, _worker
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+    _connection = get_connection()
+    _connection.open()
+    _worker = True
+
+
+def _send_chunk(base_url, chunk, users, opaque=None):
+    results, valid = {}, []
+    for email in chunk:
+        try:
+            validate_email(email)
+        except ValidationError:
+            results[email] = "Invalid email address"
+        else:
+            valid.append(email)
+    for email, error in send_registration_mails(
+        valid,
+        base_url,
+        users=users,
+        chunk_size=len(chunk),
+        connection=_connection,
+        opaque=opaque,
+    ):
+        if error is not None:
+            results[email] = "%s: %s" % (type(error).__name__, error)
+    if _worker:
+        # Workers exit using os._exit(), the sink's thread and atexit
+        # handler never get to write the records.
+        audit.flush()
+    return [(email, results.get(email)) for email in chunk]
+
+
+def read_emails(stream, format):
+    """
+    Yields the email addresses from a CSV file (an ``email`` column or the
+    first column) or a JSON lines file (objects with an ``email`` key or
+    strings)
+    """
+    if format == "jsonl":
+        for line in stream:
+            if line.strip():
+                data = json.loads(line)
+                yield data["email"] if isinstance(data, dict) else data
+        return
+
+    reader = csv.reader(stream)
+    column = 0
+    for row in reader:
+        header = [cell.strip().lower() for cell in row]
+        if "email" in header:
+            column = header.index("email")
+        elif row:
+            yield row[column].strip()
+        break
+    for row in reader:
+        if row:
+            yield row[column].strip()
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends registration links to the addresses in a CSV or JSON lines"
+        " file, or set password links if a user with the address exists"
+        " already."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="The input file, '-' for stdin.")
+        parser.add_argument(
+            "--format",
+            choices=["csv", "jsonl"],
+            help="Defaults to jsonl for files ending with .jsonl, csv otherwise.",
+        )
+        parser.add_argument(
+            "--base-url",
+            help="Defaults to EMAIL_REGISTRATION_BASE_URL or the current site.",
+        )
+        parser.add_argument(
+            "--opaque",
+            action="store_true",
+            default=None,
+            help="Sends short opaque codes, defaults to"
+            " EMAIL_REGISTRATION_OPAQUE_CODES.",
+        )
+        parser.add_argument("--processes", type=int, default=1)
+        parser.add_argument("--chunk-size", type=int, default=100)
+        parser.add_argument(
+            "--checkpoint",
+            metavar="FILE",
+            help="Records the progress in FILE and skips the addresses"
+            " processed already when restarted.",
+        )
+        parser.add_argument(
+            "--failures",
+            metavar="FILE",
+            help="Appends failed addresses and the error to FILE (CSV).",
+        )
+
+    def handle(self, **options):
+        global _connection
+        self.verbosity = options["verbosity"]
+        base_url = options["base_url"] or get_base_url()
+        format = options["format"] or (
+            "jsonl" if options["input"].endswith(".jsonl") else "csv"
+        )
+        self.checkpoint = options["checkpoint"]
+        self.opaque = options["opaque"]
+        offset = self._load_checkpoint()
+
+        stream = (
+            sys.stdin
+            if options["input"] == "-"
+            else open(options["input"], newline="", encoding="utf-8")
+        )
+        failures = (
+            open(options["failures"], "a", newline="", encoding="utf-8")
+            if options["failures"]
+            else None
+        )
+        self.failures = failures and csv.writer(failures)
+        self.sent = self.failed = 0
+        self.offset = offset
+        self.started = time.monotonic()
+
+        try:
+            emails = islice(read_emails(stream, format), offset, None)
+            chunks = iter(lambda: list(islice(emails, options["chunk_size"])), [])
+            if options["processes"] > 1:
+                self._run_pool(base_url, chunks, options["processes"])
+            else:
+                with get_connection() as connection:
+                    _connection = connection
+                    for chunk in chunks:
+                        self._done(
+                            len(chunk),
+                            _send_chunk(base_url, chunk, _users(chunk), self.opaque),
+                        )
+        except KeyboardInterrupt:
+            raise CommandError(
+                "Interrupted after %s addresses." % self.offset
+                + (" Restart to resume." if self.checkpoint else "")
+            )
+        finally:
+            _connection = None
+            if stream is not sys.stdin:
+                stream.close()
+            if failures:
+                failures.close()
+            if self.verbosity:
+                self._report()
+
+    def _run_pool(self, base_url, chunks, processes):
+        # The workers do not use the database; users are looked up here.
+        connections.close_all()
+        pending = deque()
+        with ProcessPoolExecutor(processes, initializer=_init_worker) as pool:
+            for chunk in chunks:
+                pending.append(
+                    (
+                        len(chunk),
+                        pool.submit(
+                            _send_chunk, base_url, chunk, _users(chunk), self.opaque
+                        ),
+                    )
+                )
+                # Results are processed in input order so that the checkpoint
+                # never skips addresses which have not been processed yet.
+                while pending and (
+                    len(pending) >= 2 * processes or pending[0][1].done()
+                ):
+                    count, future = pending.popleft()
+                    self._done(count, future.result())
+            while pending:
+                count, future = pending.popleft()
+                self._done(count, future.result())
+
+    def _done(self, count, results):
+        for email, error in results:
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+                if self.failures:
+                    self.failures.writerow([email, error])
+        self.offset += count
+        self._save_checkpoint()
+        if self.verbosity > 1:
+            self._report()
+
+    def _report(self):
+        elapsed = time.monotonic() - self.started
+        self.stderr.write(
+            "%s sent, %s failed in %.1fs (%.0f mails/s)"
+            % (
+                self.sent,
+                self.failed,
+                elapsed,
+                (self.sent + self.failed) / elapsed if elapsed else 0,
+            )
+        )
+
+    def _load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return 0
+        with open(self.checkpoint) as f:
+            return json.load(f)["offset"]
+
+    def _save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        tmp = "%s.tmp" % self.checkpoint
+        with open(tmp, "w") as f:
+            json.dump({"offset": self.offset}, f)
+        os.replace(tmp, self.checkpoint)
+
+
+def _users(chunk):
+    # Existing users receive set password links
+    info = get_user_model_info()
+    if not info.email_field:
+        return {}
+    normalized = {email: normalize_email(email) for email in chunk}
+    users = {
+        getattr(user, info.email_field): user
+        for user in info.model._default_manager.filter(
+            **{"%s__in" % info.email_field: normalized.values()}
+        ).only(*info.restricted_fields)
+    }
+    return {
+        email: users[normalized[email]] for email in chunk if normalized[email] in users
+    }
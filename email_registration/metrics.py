@@ -0,0 +1,103 @@
+"""
+Instrumentation of the registration flow
+
+Set ``EMAIL_REGISTRATION_METRICS_SINK`` to the dotted path of a sink class
+to record durations and counters, e.g. to forward them to statsd or
+Prometheus. The sink is instantiated once using the keyword arguments from
+``EMAIL_REGISTRATION_METRICS_OPTIONS`` and has to provide two methods:
+
+* ``timing(name, seconds, **tags)`` receives the duration of a stage:
+  ``form_validation``, ``exists_query``, ``reverse``, ``sign``, ``unsign``,
+  ``user_query``, ``render`` and ``send``.
+* ``incr(name, value=1, **tags)`` receives the counters ``mails_sent``,
+  ``mails_dropped`` (discarded by the delivery backend),
+  ``codes_decoded`` and ``decode_failures`` (tagged with the ``reason`` of
+  the ``InvalidCode`` exception: ``expired``, ``bad_signature``,
+  ``malformed``, ``unknown_user`` or ``used``) and ``fast_rejects``
+  (tagged the same way, see ``email_registration.views.fast_reject``).
+
+Without a sink, ``timed`` and ``incr`` do nothing except checking whether a
+sink is configured.
+"""
+
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+
+from email_registration.conf import SettingInstance
+
+
+class MemorySink:
+    """
+    Records everything in memory, useful for tests
+
+    ``spans`` is a list of ``(name, seconds, tags)`` tuples, ``counters`` a
+    ``Counter`` keyed by ``(name, tags)`` where ``tags`` is a sorted tuple of
+    ``(key, value)`` pairs.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def timing(self, name, seconds, **tags):
+        with self._lock:
+            self.spans.append((name, seconds, tags))
+
+    def incr(self, name, value=1, **tags):
+        with self._lock:
+            self.counters[(name, tuple(sorted(tags.items())))] += value
+
+    def count(self, name, **tags):
+        """Returns the value of a counter"""
+        return self.counters[(name, tuple(sorted(tags.items())))]
+
+
+class _Timer:
+    __slots__ = ("sink", "name", "tags", "start")
+
+    def __init__(self, sink, name, tags):
+        self.sink = sink
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.sink.timing(self.name, time.perf_counter() - self.start, **self.tags)
+
+
+_null_timer = nullcontext()
+_sink = SettingInstance(
+    "EMAIL_REGISTRATION_METRICS_SINK", "EMAIL_REGISTRATION_METRICS_OPTIONS"
+)
+
+
+def get_sink():
+    """
+    Returns the sink configured using ``EMAIL_REGISTRATION_METRICS_SINK`` or
+    ``None``
+    """
+    return _sink.get()
+
+
+def timed(name, **tags):
+    """
+    Returns a context manager reporting the duration of the enclosed block
+    """
+    sink = _sink.get()
+    if sink is None:
+        return _null_timer
+    return _Timer(sink, name, tags)
+
+
+def incr(name, value=1, **tags):
+    """
+    Increments the counter ``name``
+    """
+    sink = _sink.get()
+    if sink is not None:
+        sink.incr(name, value, **tags)
@@ -0,0 +1,85 @@
+"""
+Normalization of email addresses
+
+Email addresses are normalized before checking whether an account exists,
+before signing them into the link and before creating the user, so that
+existence checks stay a single (indexable) equality lookup instead of a
+case-insensitive ``email__iexact`` scan.
+
+``EMAIL_REGISTRATION_NORMALIZE_EMAIL`` is the dotted path of the function
+used, ``email_registration.normalization.identity`` by default. Existing
+rows are not normalized automatically: before switching to e.g.
+``lowercase``, find the affected accounts using
+``./manage.py email_registration_duplicates --normalize <path>`` and
+migrate the stored addresses, otherwise accounts stored in mixed case are
+not found anymore and may be registered a second time.
+"""
+
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+#: Provider specific rules used by ``canonical``: Domain aliases and whether
+#: dots in the local part are ignored by the provider. The ``+tag`` suffix
+#: is removed for all those providers.
+PROVIDERS = {
+    "gmail.com": ("gmail.com", True),
+    "googlemail.com": ("gmail.com", True),
+    "outlook.com": ("outlook.com", False),
+    "hotmail.com": ("hotmail.com", False),
+    "icloud.com": ("icloud.com", False),
+    "fastmail.com": ("fastmail.com", False),
+}
+
+
+def identity(email):
+    """
+    Only strips surrounding whitespace
+    """
+    return email.strip()
+
+
+def lowercase(email):
+    """
+    Lowercases the whole address. Strictly speaking the local part is case
+    sensitive, but no relevant provider treats it that way.
+    """
+    return email.strip().lower()
+
+
+def canonical(email):
+    """
+    Lowercases the address and applies the provider specific rules from
+    ``PROVIDERS``, e.g. ``John.Doe+news@googlemail.com`` becomes
+    ``johndoe@gmail.com``
+    """
+    email = lowercase(email)
+    local, at, domain = email.rpartition("@")
+    if not at or domain not in PROVIDERS:
+        return email
+    domain, ignore_dots = PROVIDERS[domain]
+    local = local.partition("+")[0]
+    if ignore_dots:
+        local = local.replace(".", "")
+    return "%s@%s" % (local, domain)
+
+
+@lru_cache(maxsize=None)
+def _import(path):
+    return import_string(path)
+
+
+def normalize_email(email):
+    """
+    Normalizes ``email`` using the function configured using
+    ``EMAIL_REGISTRATION_NORMALIZE_EMAIL``
+    """
+    return _import(
+        getattr(
+            settings,
+            "EMAIL_REGISTRATION_NORMALIZE_EMAIL",
+            "email_registration.normalization.identity",
+        )
+    )(email)
@@ -0,0 +1,134 @@
+"""
+Short opaque codes
+
+Signed codes contain the email address and a signature, which makes links
+long (some mail clients wrap or truncate them) and shows the address in the
+URL. Set ``EMAIL_REGISTRATION_CODE_STORE`` to the dotted path of a code
+store, e.g. ``email_registration.opaque.CacheCodeStore``, to send links
+containing a short random code instead. The store maps the random code to
+the signed code; everything else (expiry, checking the user's last login,
+one-time use) works the same as with signed codes.
+
+The store is instantiated once using the keyword arguments from
+``EMAIL_REGISTRATION_CODE_STORE_OPTIONS`` and has to provide two methods:
+
+* ``set_many(mapping, timeout)`` stores the ``{code: signed_code}`` mapping
+  for ``timeout`` seconds.
+* ``get(code)`` returns the signed code or ``None`` if the code is unknown
+  or has expired.
+
+Links use opaque codes if ``EMAIL_REGISTRATION_OPAQUE_CODES`` is set or
+``opaque=True`` is passed to ``get_confirmation_url``. ``decode`` accepts
+both kinds of codes as long as a store is configured.
+"""
+
+import re
+import secrets
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from email_registration.conf import SettingInstance, get_cache
+
+
+#: Signed codes always contain colons, opaque codes never do.
+_opaque_format = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+
+class CacheCodeStore:
+    """
+    Stores the codes in a cache, ``EMAIL_REGISTRATION_CACHE`` by default
+
+    The cache evicts codes when they expire. Use a persistent backend such
+    as the database or the file based cache, the locmem cache is only
+    suitable for tests and single process deployments.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def get_cache(self):
+        return get_cache(self.cache)
+
+    def key(self, code):
+        return "email_registration:code:%s" % code
+
+    def set_many(self, mapping, timeout):
+        self.get_cache().set_many(
+            {self.key(code): value for code, value in mapping.items()}, timeout
+        )
+
+    def get(self, code):
+        return self.get_cache().get(self.key(code))
+
+
+_store = SettingInstance(
+    "EMAIL_REGISTRATION_CODE_STORE", "EMAIL_REGISTRATION_CODE_STORE_OPTIONS"
+)
+
+
+def get_code_store():
+    """
+    Returns the code store configured using ``EMAIL_REGISTRATION_CODE_STORE``
+    or ``None``
+    """
+    return _store.get()
+
+
+def use_opaque_codes(opaque=None):
+    """
+    Returns whether new links should use opaque codes; ``opaque`` overrides
+    ``EMAIL_REGISTRATION_OPAQUE_CODES`` if it is not ``None``
+    """
+    if opaque is None:
+        opaque = getattr(settings, "EMAIL_REGISTRATION_OPAQUE_CODES", False)
+    if opaque and get_code_store() is None:
+        raise ImproperlyConfigured(
+            "Opaque codes require EMAIL_REGISTRATION_CODE_STORE to be set."
+        )
+    return opaque
+
+
+def is_opaque_code(code):
+    """
+    Returns ``True`` if ``code`` looks like an opaque code and a code store
+    is configured
+    """
+    return _opaque_format.match(code) is not None and get_code_store() is not None
+
+
+def allocate_codes(signed_codes, timeout):
+    """
+    Returns an opaque code for each of the signed codes, stored in a single
+    ``set_many`` call for ``timeout`` seconds (the ``max_age`` of the links)
+    """
+    codes = [secrets.token_urlsafe(12) for _ in signed_codes]
+    get_code_store().set_many(dict(zip(codes, signed_codes)), timeout)
+    return codes
+
+
+async def aallocate_codes(signed_codes, timeout):
+    """
+    Async version of ``allocate_codes``; the store is called in a worker
+    thread because it may use the database (e.g. ``DatabaseCache``)
+    """
+    codes = [secrets.token_urlsafe(12) for _ in signed_codes]
+    await sync_to_async(get_code_store().set_many, thread_sensitive=False)(
+        dict(zip(codes, signed_codes)), timeout
+    )
+    return codes
+
+
+def resolve_code(code):
+    """
+    Returns the signed code stored for the opaque ``code`` or ``None``
+    """
+    return get_code_store().get(code)
+
+
+async def aresolve_code(code):
+    """
+    Async version of ``resolve_code``
+    """
+    return await sync_to_async(get_code_store().get, thread_sensitive=False)(code)
@@ -0,0 +1,116 @@
+"""
+Cached rendering of the registration pages
+
+The password form looks the same for every anonymous visitor of a link,
+apart from the CSRF token. Set ``EMAIL_REGISTRATION_CACHE_PAGES = True`` to
+render such pages only once per template, language, form state (including
+the user the form belongs to) and pending messages and insert the CSRF token and the string values of the context
+(e.g. the email address on the sent page) using string substitution, the
+same way ``EMAIL_REGISTRATION_PRERENDER_MAIL`` works for mails.
+
+Pages are cached per process and only for anonymous users. Templates which
+do more with the string values than output them, or which output anything
+else changing between requests, are detected where possible and always
+rendered completely; do not enable this setting if your templates (or the
+base template they extend) depend on the request in other ways, e.g. on
+``request.GET``.
+"""
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.shortcuts import render
+from django.template.loader import get_template
+from django.utils.autoreload import file_changed
+from django.utils.translation import get_language
+
+from email_registration.utils import _prerender, _substitute
+
+
+#: The cache is simply cleared when it grows beyond this number of pages
+MAX_PAGES = 1000
+
+_pages = {}
+
+
+def render_page(request, template, context, key=(), status=None, authenticated=None):
+    """
+    Renders ``template`` like ``django.shortcuts.render`` or returns the
+    cached page if ``EMAIL_REGISTRATION_CACHE_PAGES`` is set
+
+    Context values which are not strings (e.g. forms) are not substituted,
+    therefore ``key`` has to describe their state, e.g. the errors of a form.
+    ``authenticated`` is read from ``request.user`` if it is ``None``.
+    """
+    if not getattr(settings, "EMAIL_REGISTRATION_CACHE_PAGES", False):
+        return render(request, template, context, status=status)
+    if authenticated is None:
+        user = getattr(request, "user", None)
+        authenticated = user is not None and user.is_authenticated
+    if authenticated:
+        return render(request, template, context, status=status)
+
+    values = {name: value for name, value in context.items() if isinstance(value, str)}
+    # Reading the messages marks them as used, the same as rendering them
+    pending = tuple(
+        (message.level, message.tags, "%s" % message)
+        for message in messages.get_messages(request)
+    )
+    cache_key = (template, get_language(), key, pending, tuple(sorted(values)))
+    try:
+        parts = _pages[cache_key]
+    except KeyError:
+        parts = _prerender(
+            get_template(template), (*values, "csrf_token"), context, request
+        )
+        if len(_pages) >= MAX_PAGES:
+            _pages.clear()
+        _pages[cache_key] = parts
+
+    if parts is None:
+        return render(request, template, context, status=status)
+    return HttpResponse(
+        _substitute(parts, {**values, "csrf_token": get_token(request)}),
+        status=status,
+    )
+
+
+async def arender_page(request, template, context, key=(), status=None):
+    """
+    Async version of ``render_page``; loads the user using ``request.auser``
+    because ``request.user`` accesses the session synchronously
+    """
+    authenticated = False
+    if getattr(settings, "EMAIL_REGISTRATION_CACHE_PAGES", False) and hasattr(
+        request, "auser"
+    ):
+        authenticated = (await request.auser()).is_authenticated
+    return render_page(
+        request, template, context, key=key, status=status, authenticated=authenticated
+    )
+
+
+def form_state(form):
+    """
+    Returns a hashable description of the form's state for ``render_page``
+
+    The state contains the user (or model instance) the form belongs to, so
+    that templates may output e.g. ``form.user.get_username``. Forms with
+    errors are described by their errors, which is only enough if the form
+    does not output the submitted data (e.g. password fields).
+    """
+    instance = getattr(form, "user", None) or getattr(form, "instance", None)
+    return (
+        instance is not None and (instance._meta.label, instance.pk, "%s" % instance),
+        form.is_bound and form.errors.as_json(),
+    )
+
+
+@receiver(file_changed)
+@receiver(setting_changed)
+def _clear_pages(setting=None, **kwargs):
+    if setting in {None, "TEMPLATES", "LANGUAGES", "EMAIL_REGISTRATION_CACHE_PAGES"}:
+        _pages.clear()
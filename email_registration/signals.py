@@ -1,4 +1,101 @@
-from django.dispatch import Signal
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections, transaction
+from django.dispatch import Signal, receiver
+
+from email_registration.utils import get_user_database
+
+
+logger = logging.getLogger(__name__)
 
 password_set = Signal()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_signal_executor():
+    """
+    Returns the thread pool running ``password_set`` receivers if
+    ``EMAIL_REGISTRATION_SIGNAL_WORKERS`` is set, ``None`` otherwise
+    """
+    global _executor
+    workers = getattr(settings, "EMAIL_REGISTRATION_SIGNAL_WORKERS", 0)
+    if not workers:
+        return None
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=workers,
+                    thread_name_prefix="email-registration-signals",
+                )
+    return _executor
+
+
+@receiver(setting_changed)
+def _signals_setting_changed(setting, **kwargs):
+    global _executor
+    if setting == "EMAIL_REGISTRATION_SIGNAL_WORKERS":
+        with _executor_lock:
+            executor, _executor = _executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def _send_robust(**kwargs):
+    close_old_connections()
+    try:
+        responses = password_set.send_robust(**kwargs)
+    finally:
+        close_old_connections()
+    for receiver_, response in responses:
+        if isinstance(response, Exception):
+            logger.error(
+                "password_set receiver %r failed",
+                receiver_,
+                exc_info=(type(response), response, response.__traceback__),
+            )
+
+
+def send_password_set(sender, **kwargs):
+    """
+    Sends ``password_set``
+
+    * ``EMAIL_REGISTRATION_ON_COMMIT = True`` sends the signal only after
+      the current transaction of the database users are written to has been
+      committed (immediately when not in a transaction, e.g. without
+      ``ATOMIC_REQUESTS``) and not at all if it is rolled back.
+    * ``EMAIL_REGISTRATION_SIGNAL_WORKERS`` runs the receivers in a pool of
+      this many background threads. Exceptions raised by receivers are
+      logged instead of propagating. Receivers should not depend on the
+      request still being processed.
+    """
+    executor = get_signal_executor()
+    if executor is None:
+        send = partial(password_set.send, sender=sender, **kwargs)
+    else:
+        send = partial(executor.submit, _send_robust, sender=sender, **kwargs)
+
+    if getattr(settings, "EMAIL_REGISTRATION_ON_COMMIT", False):
+        transaction.on_commit(send, using=get_user_database(write=True))
+    else:
+        send()
+
+
+async def asend_password_set(sender, **kwargs):
+    """
+    Async version of ``send_password_set`` using ``Signal.asend``; there is
+    no transaction to wait for in async views
+    """
+    executor = get_signal_executor()
+    if executor is None:
+        await password_set.asend(sender=sender, **kwargs)
+    else:
+        executor.submit(_send_robust, sender=sender, **kwargs)
@@ -0,0 +1,143 @@
+"""
+Rate limiting and deduplication of registration requests
+
+Both use the cache returned by ``email_registration.utils.get_cache`` and are
+disabled by default. Configuration example::
+
+    EMAIL_REGISTRATION_RATE_LIMITS = {
+        # At most 20 requests per IP address and 3 requests per email address
+        # in any (sliding) window of one hour.
+        "ip": (20, 3600),
+        "email": (3, 3600),
+    }
+    # Do not send another mail to an address for 10 minutes.
+    EMAIL_REGISTRATION_DEDUPLICATE_TIMEOUT = 600
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+
+from email_registration.normalization import normalize_email
+from email_registration.utils import get_cache
+
+
+def _key(*parts):
+    return "email_registration:%s:%s" % (
+        ":".join(parts[:-1]),
+        hashlib.sha256(parts[-1].encode()).hexdigest(),
+    )
+
+
+def hit(scope, identifier, limit, window):
+    """
+    Counts a hit for ``identifier`` and returns ``True`` if there were more
+    than ``limit`` hits during the last ``window`` seconds
+
+    The sliding window is approximated by weighting the counter of the
+    previous fixed window with the fraction of it still inside the sliding
+    window. This needs a constant number of cache operations per hit.
+    """
+    now = time.time()
+    current = int(now // window)
+    key = _key("rl", scope, identifier)
+    cache = get_cache()
+
+    cache.add("%s:%s" % (key, current), 0, 2 * window)
+    try:
+        count = cache.incr("%s:%s" % (key, current))
+    except ValueError:  # Expired between add() and incr()
+        cache.set("%s:%s" % (key, current), 1, 2 * window)
+        count = 1
+    previous = cache.get("%s:%s" % (key, current - 1), 0)
+    return count + previous * (1 - now % window / window) > limit
+
+
+async def ahit(scope, identifier, limit, window):
+    """
+    Async version of ``hit``
+    """
+    now = time.time()
+    current = int(now // window)
+    key = _key("rl", scope, identifier)
+    cache = get_cache()
+
+    await cache.aadd("%s:%s" % (key, current), 0, 2 * window)
+    try:
+        count = await cache.aincr("%s:%s" % (key, current))
+    except ValueError:  # Expired between aadd() and aincr()
+        await cache.aset("%s:%s" % (key, current), 1, 2 * window)
+        count = 1
+    previous = await cache.aget("%s:%s" % (key, current - 1), 0)
+    return count + previous * (1 - now % window / window) > limit
+
+
+def is_throttled(request, email):
+    """
+    Returns ``True`` if the registration request exceeds one of the limits
+    configured in ``EMAIL_REGISTRATION_RATE_LIMITS``; ``email`` is ignored
+    if it is not a string
+    """
+    limits = getattr(settings, "EMAIL_REGISTRATION_RATE_LIMITS", None)
+    if not limits:
+        return False
+    if "ip" in limits and hit("ip", request.META.get("REMOTE_ADDR", ""), *limits["ip"]):
+        return True
+    # JSON clients may send anything, the form rejects values which are not
+    # strings later on.
+    if "email" in limits and email and isinstance(email, str):
+        return hit("email", normalize_email(email), *limits["email"])
+    return False
+
+
+def is_duplicate(email):
+    """
+    Returns ``True`` if a registration mail has already been sent to ``email``
+    during the last ``EMAIL_REGISTRATION_DEDUPLICATE_TIMEOUT`` seconds,
+    remembers the address otherwise
+    """
+    timeout = getattr(settings, "EMAIL_REGISTRATION_DEDUPLICATE_TIMEOUT", 0)
+    if not timeout:
+        return False
+    return not get_cache().add(_key("dedup", normalize_email(email)), 1, timeout)
+
+
+def forget_duplicate(email):
+    """
+    Forgets that a mail has been sent to ``email``, e.g. because sending failed
+    """
+    get_cache().delete(_key("dedup", normalize_email(email)))
+
+
+async def ais_throttled(request, email):
+    """
+    Async version of ``is_throttled``
+    """
+    limits = getattr(settings, "EMAIL_REGISTRATION_RATE_LIMITS", None)
+    if not limits:
+        return False
+    if "ip" in limits and await ahit(
+        "ip", request.META.get("REMOTE_ADDR", ""), *limits["ip"]
+    ):
+        return True
+    if "email" in limits and email and isinstance(email, str):
+        return await ahit("email", normalize_email(email), *limits["email"])
+    return False
+
+
+async def ais_duplicate(email):
+    """
+    Async version of ``is_duplicate``
+    """
+    timeout = getattr(settings, "EMAIL_REGISTRATION_DEDUPLICATE_TIMEOUT", 0)
+    if not timeout:
+        return False
+    return not await get_cache().aadd(_key("dedup", normalize_email(email)), 1, timeout)
+
+
+async def aforget_duplicate(email):
+    """
+    Async version of ``forget_duplicate``
+    """
+    await get_cache().adelete(_key("dedup", normalize_email(email)))
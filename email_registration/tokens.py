@@ -0,0 +1,148 @@
+"""
+One-time use of registration links
+
+Links for new users do not contain anything which changes after the
+password has been set, so they could be used again until they expire (the
+check for an existing account is racy too). Set
+``EMAIL_REGISTRATION_TOKEN_STORE`` to the dotted path of a token store, e.g.
+``email_registration.tokens.CacheTokenStore``, to mark codes as consumed
+when the password is set. The store is instantiated once using the keyword
+arguments from ``EMAIL_REGISTRATION_TOKEN_STORE_OPTIONS`` and has to
+provide two methods:
+
+* ``consume(code, timeout)`` atomically marks the code as consumed and
+  returns ``True``, or returns ``False`` if it has been consumed already.
+* ``is_consumed(code)`` returns whether the code has been consumed.
+
+and may provide ``release(code)`` to undo ``consume``, e.g. when saving the
+user fails.
+"""
+
+import hashlib
+import os
+import tempfile
+
+from asgiref.sync import sync_to_async
+from django.core.cache.backends.filebased import FileBasedCache
+
+from email_registration.conf import SettingInstance, get_cache
+
+
+class CacheTokenStore:
+    """
+    Stores consumed codes in a cache, ``EMAIL_REGISTRATION_CACHE`` by default
+
+    ``consume`` uses ``cache.add`` which is atomic for the locmem, memcached,
+    Redis and database backends. ``FileBasedCache.add`` checks and writes in
+    two steps, therefore the file is created using ``os.link`` for this
+    backend which fails if the file exists already.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def get_cache(self):
+        return get_cache(self.cache)
+
+    def key(self, code):
+        return "email_registration:consumed:%s" % (
+            hashlib.sha256(code.encode()).hexdigest()
+        )
+
+    def consume(self, code, timeout):
+        cache = self.get_cache()
+        if isinstance(cache, FileBasedCache):
+            return _file_cache_add(cache, self.key(code), 1, timeout)
+        return cache.add(self.key(code), 1, timeout)
+
+    def is_consumed(self, code):
+        return self.get_cache().has_key(self.key(code))
+
+    def release(self, code):
+        self.get_cache().delete(self.key(code))
+
+
+def _file_cache_add(cache, key, value, timeout):
+    if cache.has_key(key):  # Also removes the file if it is expired
+        return False
+    cache._createdir()
+    fname = cache._key_to_file(key)
+    fd, tmp_path = tempfile.mkstemp(dir=cache._dir)
+    try:
+        with open(fd, "wb") as f:
+            cache._write_content(f, timeout, value)
+        os.link(tmp_path, fname)
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+    return True
+
+
+_store = SettingInstance(
+    "EMAIL_REGISTRATION_TOKEN_STORE", "EMAIL_REGISTRATION_TOKEN_STORE_OPTIONS"
+)
+
+
+def get_token_store():
+    """
+    Returns the token store configured using
+    ``EMAIL_REGISTRATION_TOKEN_STORE`` or ``None``
+    """
+    return _store.get()
+
+
+def consume_code(code, timeout):
+    """
+    Marks ``code`` as consumed for ``timeout`` seconds (the ``max_age`` of
+    the link) and returns ``True``, or ``False`` if the code has been
+    consumed already. Always returns ``True`` without a token store.
+    """
+    store = get_token_store()
+    return store is None or store.consume(code, timeout)
+
+
+def is_consumed(code):
+    """
+    Returns ``True`` if ``code`` has been consumed already
+    """
+    store = get_token_store()
+    return store is not None and store.is_consumed(code)
+
+
+def release_code(code):
+    """
+    Undoes ``consume_code``
+    """
+    store = get_token_store()
+    if store is not None and hasattr(store, "release"):
+        store.release(code)
+
+
+async def aconsume_code(code, timeout):
+    """
+    Async version of ``consume_code``
+    """
+    store = get_token_store()
+    return store is None or await sync_to_async(store.consume, thread_sensitive=False)(
+        code, timeout
+    )
+
+
+async def ais_consumed(code):
+    """
+    Async version of ``is_consumed``
+    """
+    store = get_token_store()
+    return store is not None and await sync_to_async(
+        store.is_consumed, thread_sensitive=False
+    )(code)
+
+
+async def arelease_code(code):
+    """
+    Async version of ``release_code``
+    """
+    store = get_token_store()
+    if store is not None and hasattr(store, "release"):
+        await sync_to_async(store.release, thread_sensitive=False)(code)
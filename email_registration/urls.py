@@ -1,6 +1,14 @@
 from django.urls import path
 
-from email_registration.views import email_registration_confirm, email_registration_form
+from email_registration.views import (
+    aemail_registration_confirm,
+    aemail_registration_form,
+    email_registration_api_confirm,
+    email_registration_api_form,
+    email_registration_api_validate,
+    email_registration_confirm,
+    email_registration_form,
+)
 
 
 urlpatterns = [
@@ -15,3 +23,42 @@ urlpatterns = [
         name="email_registration_confirm",
     ),
 ]
+
+# The same views implemented using async def, for projects running on ASGI:
+#
+#     from email_registration.urls import async_urlpatterns
+#     path("er/", include(async_urlpatterns)),
+async_urlpatterns = [
+    path(
+        "",
+        aemail_registration_form,
+        name="email_registration_form",
+    ),
+    path(
+        "<str:code>/",
+        aemail_registration_confirm,
+        name="email_registration_confirm",
+    ),
+]
+
+# JSON endpoints for single page applications, e.g.
+#
+#     from email_registration.urls import api_urlpatterns
+#     path("api/er/", include(api_urlpatterns)),
+api_urlpatterns = [
+    path(
+        "",
+        email_registration_api_form,
+        name="email_registration_api_form",
+    ),
+    path(
+        "<str:code>/validate/",
+        email_registration_api_validate,
+        name="email_registration_api_validate",
+    ),
+    path(
+        "<str:code>/",
+        email_registration_api_confirm,
+        name="email_registration_api_confirm",
+    ),
+]
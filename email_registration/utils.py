@@ -1,48 +1,287 @@
-from django.contrib.auth.models import User
+import hashlib
+import hmac
+import re
+import time
+from collections import namedtuple
+from contextlib import nullcontext
+from functools import lru_cache, partial
+from itertools import islice
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.core import signing
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import TemplateDoesNotExist, render_to_string
-from django.utils.http import int_to_base36
-from django.utils.translation import gettext as _
+from django.core.exceptions import (
+    FieldDoesNotExist,
+    ImproperlyConfigured,
+    ObjectDoesNotExist,
+    ValidationError,
+)
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.signals import setting_changed
+from django.db import router, transaction
+from django.dispatch import receiver
+from django.template.loader import TemplateDoesNotExist, get_template
+from django.urls import NoReverseMatch, get_script_prefix, get_urlconf, reverse
+from django.utils.autoreload import file_changed
+from django.utils.crypto import get_random_string
+from django.utils.encoding import force_bytes
+from django.utils.html import conditional_escape
+from django.utils.http import RFC3986_SUBDELIMS
+from django.utils.translation import get_language, gettext as _
+
+from email_registration import audit, codec, metrics
+from email_registration.conf import get_cache
+from email_registration.delivery import get_delivery_backend
+from email_registration.normalization import normalize_email
+from email_registration.opaque import (
+    aallocate_codes,
+    allocate_codes,
+    aresolve_code,
+    is_opaque_code,
+    resolve_code,
+    use_opaque_codes,
+)
+from email_registration.tokens import ais_consumed, is_consumed
+
+
+UserModelInfo = namedtuple(
+    "UserModelInfo", "model username_field email_field restricted_fields"
+)
+
+
+def get_user_model_info():
+    """
+    Returns information about the user model used by the views, resolved
+    once per ``AUTH_USER_MODEL`` instead of on every request:
+
+    * ``model``: The user model.
+    * ``username_field``: The field instance of ``USERNAME_FIELD``.
+    * ``email_field``: ``"email"`` if the model has such a field, ``None``
+      otherwise.
+    * ``restricted_fields``: The fields loaded by ``decode`` when
+      ``restrict_fields`` is set.
+    """
+    return _user_model_info(settings.AUTH_USER_MODEL)
+
+
+@lru_cache(maxsize=None)
+def _user_model_info(auth_user_model):
+    User = get_user_model()
+    restricted_fields = ["last_login", User.USERNAME_FIELD]
+    try:
+        User._meta.get_field("email")
+        email_field = "email"
+    except FieldDoesNotExist:
+        email_field = None
+    try:
+        restricted_fields.append(User._meta.get_field(User.get_email_field_name()).name)
+    except FieldDoesNotExist:
+        pass
+    return UserModelInfo(
+        User,
+        User._meta.get_field(User.USERNAME_FIELD),
+        email_field,
+        tuple(restricted_fields),
+    )
+
+
+class CachedHMACSigner(signing.TimestampSigner):
+    """
+    ``TimestampSigner`` which derives the HMAC key from each secret key only
+    once and reuses the resulting HMAC state for all signatures
+    """
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._macs = {}
 
-try:
-    from django.urls import reverse
-except ImportError:  # pragma: no cover
-    from django.core.urlresolvers import reverse
+    def signature(self, value, key=None):
+        key = key or self.key
+        try:
+            mac = self._macs[key]
+        except KeyError:
+            hasher = getattr(hashlib, self.algorithm)
+            mac = self._macs[key] = hmac.new(
+                hasher(force_bytes(self.salt + "signer") + force_bytes(key)).digest(),
+                digestmod=hasher,
+            )
+        mac = mac.copy()
+        mac.update(force_bytes(value))
+        return signing.b64_encode(mac.digest()).decode()
 
 
-def get_signer(salt="email_registration"):
+def get_signer(salt="email_registration", algorithm=None):
     """
     Returns the signer instance used to sign and unsign the registration
     link tokens
+
+    The HMAC algorithm defaults to ``EMAIL_REGISTRATION_SIGNING_ALGORITHM``
+    or Django's default (SHA-256). Signer instances are cached per salt,
+    algorithm and secret keys; changing ``SECRET_KEY`` or
+    ``SECRET_KEY_FALLBACKS`` returns a new instance.
     """
-    return signing.TimestampSigner(salt=salt)
+    return _get_signer(
+        salt,
+        algorithm or getattr(settings, "EMAIL_REGISTRATION_SIGNING_ALGORITHM", None),
+        settings.SECRET_KEY,
+        tuple(getattr(settings, "SECRET_KEY_FALLBACKS", ())),
+    )
+
+
+@lru_cache(maxsize=16)
+def _get_signer(salt, algorithm, key, fallback_keys):
+    kwargs = {"fallback_keys": fallback_keys} if fallback_keys else {}
+    return CachedHMACSigner(key=key, salt=salt, algorithm=algorithm, **kwargs)
+
+
+def unsign(code, max_age):
+    """
+    Verifies the signature and age of ``code`` and returns the payload
+
+    Codes signed using one of the algorithms in
+    ``EMAIL_REGISTRATION_SIGNING_FALLBACK_ALGORITHMS`` are accepted as well,
+    so that links sent before switching the algorithm keep working. Raises
+    ``django.core.signing.BadSignature`` or ``SignatureExpired``.
+    """
+    try:
+        return get_signer().unsign(code, max_age=max_age)
+    except signing.SignatureExpired:
+        raise
+    except signing.BadSignature:
+        for algorithm in getattr(
+            settings, "EMAIL_REGISTRATION_SIGNING_FALLBACK_ALGORITHMS", ()
+        ):
+            try:
+                return get_signer(algorithm=algorithm).unsign(code, max_age=max_age)
+            except signing.SignatureExpired:
+                raise
+            except signing.BadSignature:
+                pass
+        raise
 
 
 def get_last_login_timestamp(user):
     """
-    Django 1.7 allows the `last_login` timestamp to be `None` for new users.
+    Returns the epoch of ``user.last_login``. Django 1.7 allows the
+    `last_login` timestamp to be `None` for new users, ``0`` is returned then.
     """
-    return int(user.last_login.strftime("%s")) if user.last_login else 0
+    return codec.last_login_timestamp(user)
 
 
-def get_confirmation_url(email, request, user=None):
+def get_confirmation_url(email, request, user=None, opaque=None, max_age=3 * 86400):
     """
     Returns the confirmation URL
+
+    ``request`` is either a HTTP request instance, a base URL such as
+    ``"https://example.com"`` to which the path of the confirmation view is
+    appended or a ``Site`` (or ``RequestSite``) instance, in which case the
+    link uses ``https://<domain>``.
+
+    The email address is normalized using ``normalize_email`` before
+    signing it.
+
+    ``opaque=True`` returns a link containing a short random code which is
+    stored for ``max_age`` seconds, see ``email_registration.opaque``.
+    Defaults to ``EMAIL_REGISTRATION_OPAQUE_CODES``.
     """
-    code = [email, "", ""]
-    if user:
-        code[1] = str(user.id)
-        code[2] = int_to_base36(get_last_login_timestamp(user))
-
-    return request.build_absolute_uri(
-        reverse(
-            "email_registration_confirm",
-            kwargs={
-                "code": get_signer().sign(":".join(code)),
-            },
-        )
+    code = _sign(email, user)
+    if use_opaque_codes(opaque):
+        (code,) = allocate_codes([code], max_age)
+    return _confirmation_url(request, code)
+
+
+async def aget_confirmation_url(
+    email, request, user=None, opaque=None, max_age=3 * 86400
+):
+    """
+    Async version of ``get_confirmation_url``, storing opaque codes using
+    ``aallocate_codes``
+    """
+    code = _sign(email, user)
+    if use_opaque_codes(opaque):
+        (code,) = await aallocate_codes([code], max_age)
+    return _confirmation_url(request, code)
+
+
+def _sign(email, user):
+    with metrics.timed("sign"):
+        return get_signer().sign(codec.dumps(normalize_email(email), user))
+
+
+def _confirmation_url(request, code):
+    with metrics.timed("reverse"):
+        path = get_confirmation_path(code)
+    if isinstance(request, str):
+        return request.rstrip("/") + path
+    if not hasattr(request, "build_absolute_uri") and hasattr(request, "domain"):
+        return "https://%s%s" % (request.domain, path)
+    return request.build_absolute_uri(path)
+
+
+_CODE_PLACEHOLDER = "emailregistrationcode"
+_confirmation_paths = {}
+
+
+def get_confirmation_path(code):
+    """
+    Returns the path of the confirmation view for ``code``
+
+    ``reverse()`` only runs once per URLconf, script prefix and language
+    (patterns may be translated or use ``i18n_patterns``); the path is split
+    at a placeholder code and later codes are quoted and inserted the same
+    way ``reverse()`` would. Codes containing slashes (which cannot be
+    matched by the ``str`` path converter) and URL patterns not accepting
+    the placeholder always use ``reverse()``.
+    """
+    key = (get_urlconf(), get_script_prefix(), get_language())
+    try:
+        parts = _confirmation_paths[key]
+    except KeyError:
+        parts = _confirmation_paths[key] = _reverse_parts()
+
+    if parts is None or "/" in code:
+        return reverse("email_registration_confirm", kwargs={"code": code})
+    return "%s%s%s" % (
+        parts[0],
+        quote(code, safe=RFC3986_SUBDELIMS + "/~:@"),
+        parts[1],
+    )
+
+
+def _reverse_parts():
+    try:
+        parts = reverse(
+            "email_registration_confirm", kwargs={"code": _CODE_PLACEHOLDER}
+        ).split(_CODE_PLACEHOLDER)
+    except NoReverseMatch:
+        return None
+    return tuple(parts) if len(parts) == 2 else None
+
+
+@receiver(setting_changed)
+def _clear_confirmation_paths(setting, **kwargs):
+    if setting in {"ROOT_URLCONF", "FORCE_SCRIPT_NAME", "LANGUAGES"}:
+        _confirmation_paths.clear()
+
+
+def get_base_url():
+    """
+    Returns the base URL for links in mails sent outside of requests, e.g. by
+    management commands: ``EMAIL_REGISTRATION_BASE_URL`` or the domain of the
+    current site (using ``https``) if ``django.contrib.sites`` is installed
+    """
+    base_url = getattr(settings, "EMAIL_REGISTRATION_BASE_URL", None)
+    if base_url:
+        return base_url
+    if apps.is_installed("django.contrib.sites"):
+        from django.contrib.sites.models import Site
+
+        return "https://%s" % Site.objects.get_current().domain
+    raise ImproperlyConfigured(
+        "Set EMAIL_REGISTRATION_BASE_URL or install django.contrib.sites."
     )
 
 
@@ -65,24 +304,196 @@ def send_registration_mail(email, request, user=None):
     * ``registration/email_registration_email.html``: The body of the HTML
       version of the mail. This template is **NOT** available by default and
       is not required either.
+
+    The rendered message is handed to the delivery backend configured using
+    ``EMAIL_REGISTRATION_DELIVERY_BACKEND``, which sends it right away by
+    default. See ``email_registration.delivery`` for alternatives. With
+    ``EMAIL_REGISTRATION_ON_COMMIT = True`` the message is only handed over
+    after the current transaction has been committed.
+
+    The outcome is recorded in the audit log if
+    ``EMAIL_REGISTRATION_AUDIT_SINK`` is set, see
+    ``email_registration.audit``.
     """
 
-    render_to_mail(
+    issued_at = time.time()
+    message = render_to_mail(
         "registration/email_registration_email",
         {
             "url": get_confirmation_url(email, request, user=user),
         },
         to=[email],
-    ).send()
+    )
+    deliver = partial(_deliver, message, email, user, issued_at)
+    if getattr(settings, "EMAIL_REGISTRATION_ON_COMMIT", False):
+        # The user (or whatever prompted the mail) is written to this database
+        transaction.on_commit(deliver, using=get_user_database(write=True))
+    else:
+        deliver()
+
+
+def _deliver(message, email, user, issued_at):
+    try:
+        with metrics.timed("send"):
+            delivered = get_delivery_backend().deliver(message)
+    except Exception:
+        audit.record(email, user, "failed", issued_at)
+        raise
+    if delivered is False:
+        metrics.incr("mails_dropped")
+        audit.record(email, user, "dropped", issued_at)
+    else:
+        metrics.incr("mails_sent")
+        audit.record(email, user, "sent", issued_at)
+
+
+async def asend_registration_mail(email, request, user=None):
+    """
+    Async version of ``send_registration_mail``
+
+    The delivery backend is called in a worker thread so that a slow mail
+    server does not block the event loop.
+    """
+    issued_at = time.time()
+    message = render_to_mail(
+        "registration/email_registration_email",
+        {
+            "url": await aget_confirmation_url(email, request, user=user),
+        },
+        to=[email],
+    )
+    await sync_to_async(_deliver, thread_sensitive=False)(
+        message, email, user, issued_at
+    )
+
+
+def send_registration_mails(
+    emails,
+    request,
+    users=None,
+    chunk_size=None,
+    connection=None,
+    opaque=None,
+    max_age=3 * 86400,
+):
+    """
+    Sends registration mails to many addresses at once
+
+    * ``emails``: An iterable of email addresses. The iterable is consumed
+      lazily, it may be a generator reading a large file.
+    * ``request``: A HTTP request instance or a base URL, see
+      ``get_confirmation_url``.
+    * ``users``: Optional mapping of email addresses to user instances for
+      addresses where the user exists already.
+    * ``chunk_size``: The number of messages rendered (and, with ``opaque``,
+      codes stored) at once. Defaults to the
+      ``EMAIL_REGISTRATION_BULK_CHUNK_SIZE`` setting or 100.
+    * ``connection``: An open mail connection which is reused and not closed
+      afterwards. A new connection is opened and closed if omitted.
+    * ``opaque`` and ``max_age``: See ``get_confirmation_url``. The opaque
+      codes of a chunk are stored at once.
+
+    All messages are sent through a single mail connection, bypassing the
+    delivery backend. Returns an iterator yielding an ``(email, error)`` tuple
+    for every address where ``error`` is ``None`` if the mail has been sent
+    successfully. Mails are only sent while the iterator is consumed::
+
+        for email, error in send_registration_mails(emails, request):
+            if error:
+                ...
+    """
+    if chunk_size is None:
+        chunk_size = getattr(settings, "EMAIL_REGISTRATION_BULK_CHUNK_SIZE", 100)
+    users = users or {}
+    emails = iter(emails)
+    opaque = use_opaque_codes(opaque)
+
+    with nullcontext(connection) if connection else get_connection() as connection:
+        while True:
+            chunk = list(islice(emails, chunk_size))
+            if not chunk:
+                return
+            issued_at = time.time()
+
+            codes = []
+            for email in chunk:
+                try:
+                    codes.append(_sign(email, users.get(email)))
+                except Exception as exc:
+                    codes.append(exc)
+            if opaque:
+                signed = [code for code in codes if isinstance(code, str)]
+                try:
+                    allocated = iter(allocate_codes(signed, max_age))
+                except Exception as exc:
+                    codes = [exc] * len(codes)
+                else:
+                    codes = [
+                        next(allocated) if isinstance(code, str) else code
+                        for code in codes
+                    ]
+
+            results, messages = [], []
+            for email, code in zip(chunk, codes):
+                if isinstance(code, Exception):
+                    results.append((email, code))
+                    continue
+                try:
+                    messages.append(
+                        (
+                            len(results),
+                            render_to_mail(
+                                "registration/email_registration_email",
+                                {"url": _confirmation_url(request, code)},
+                                to=[email],
+                                connection=connection,
+                            ),
+                        )
+                    )
+                except Exception as exc:
+                    results.append((email, exc))
+                else:
+                    results.append((email, None))
+
+            if messages:
+                # Messages are passed one at a time so that a failure (e.g. a
+                # refused recipient) is only reported for the affected address
+                # and not for the messages of the chunk sent already.
+                sent = 0
+                with metrics.timed("send"):
+                    for index, message in messages:
+                        try:
+                            connection.send_messages([message])
+                        except Exception as exc:
+                            results[index] = (results[index][0], exc)
+                        else:
+                            sent += 1
+                if sent:
+                    metrics.incr("mails_sent", sent)
+
+            for email, error in results:
+                audit.record(
+                    email,
+                    users.get(email),
+                    "sent" if error is None else "failed",
+                    issued_at,
+                )
+            yield from results
 
 
 class InvalidCode(Exception):
-    """Problems occurred during decoding the registration link"""
+    """Problems occurred during decoding the registration link
+
+    ``reason`` is one of ``"expired"``, ``"bad_signature"``, ``"malformed"``,
+    ``"unknown_user"`` and ``"used"``.
+    """
 
-    pass
+    def __init__(self, message, reason=None):
+        super().__init__(message)
+        self.reason = reason
 
 
-def decode(code, max_age=3 * 86400):
+def decode(code, max_age=3 * 86400, restrict_fields=None, using=None, opaque=None):
     """
     Decodes the code from the registration link and returns a tuple consisting
     of the verified email address and the associated user instance or ``None``
@@ -90,50 +501,284 @@ def decode(code, max_age=3 * 86400):
 
     This method raises ``InvalidCode`` exceptions containing an translated
     message what went wrong suitable for presenting directly to the user.
+
+    * ``restrict_fields``: Only fetch the primary key, ``last_login``, the
+      username and the email field of the user. Defaults to the
+      ``EMAIL_REGISTRATION_RESTRICT_USER_FIELDS`` setting or ``False``.
+      Accessing other fields later on runs additional queries.
+    * ``using``: The database alias the user is loaded from, defaults to
+      ``get_user_database()``. If the user does not exist there, e.g.
+      because of replication lag, the write database is tried as well.
+
+    If ``EMAIL_REGISTRATION_DECODE_CACHE_TIMEOUT`` is set to a number of
+    seconds the user instance is cached per code (using the cache
+    ``EMAIL_REGISTRATION_CACHE``, ``"default"`` by default) so that e.g. the
+    GET and POST request of the password form only load the user once.
+
+    Codes consumed using ``email_registration.tokens.consume_code`` are
+    rejected if a token store is configured.
+
+    Opaque codes are resolved using the code store if one is configured
+    (see ``email_registration.opaque``). ``opaque=False`` only accepts signed
+    codes, ``opaque=True`` only opaque codes.
+    """
+    email, uid, timestamp, legacy = _decode_payload(_signed_code(code, opaque), max_age)
+    if is_consumed(code):
+        raise _used_code()
+    if uid is None:
+        metrics.incr("codes_decoded")
+        return email, None
+
+    if restrict_fields is None:
+        restrict_fields = getattr(
+            settings, "EMAIL_REGISTRATION_RESTRICT_USER_FIELDS", False
+        )
+    timeout = getattr(settings, "EMAIL_REGISTRATION_DECODE_CACHE_TIMEOUT", 0)
+    key = _decode_cache_key(code, restrict_fields)
+
+    user = get_cache().get(key) if timeout else None
+    if user is None:
+        try:
+            with metrics.timed("user_query"):
+                *replicas, primary = _read_databases(using)
+                for alias in replicas:
+                    try:
+                        user = _user_queryset(restrict_fields).using(alias).get(pk=uid)
+                        break
+                    except ObjectDoesNotExist:
+                        pass
+                else:
+                    user = _user_queryset(restrict_fields).using(primary).get(pk=uid)
+        except (ObjectDoesNotExist, TypeError, ValueError, ValidationError):
+            raise _malformed_code("unknown_user")
+        if timeout:
+            get_cache().set(key, user, timeout)
+
+    if timestamp != codec.last_login_timestamp(user, legacy=legacy):
+        raise _used_code()
+    metrics.incr("codes_decoded")
+    return email, user
+
+
+async def adecode(
+    code, max_age=3 * 86400, restrict_fields=None, using=None, opaque=None
+):
+    """
+    Async version of ``decode`` using the async ORM and cache APIs
+    """
+    email, uid, timestamp, legacy = _decode_payload(
+        await _asigned_code(code, opaque), max_age
+    )
+    if await ais_consumed(code):
+        raise _used_code()
+    if uid is None:
+        metrics.incr("codes_decoded")
+        return email, None
+
+    if restrict_fields is None:
+        restrict_fields = getattr(
+            settings, "EMAIL_REGISTRATION_RESTRICT_USER_FIELDS", False
+        )
+    timeout = getattr(settings, "EMAIL_REGISTRATION_DECODE_CACHE_TIMEOUT", 0)
+    key = _decode_cache_key(code, restrict_fields)
+
+    user = await get_cache().aget(key) if timeout else None
+    if user is None:
+        try:
+            with metrics.timed("user_query"):
+                *replicas, primary = _read_databases(using)
+                for alias in replicas:
+                    try:
+                        user = await (
+                            _user_queryset(restrict_fields).using(alias).aget(pk=uid)
+                        )
+                        break
+                    except ObjectDoesNotExist:
+                        pass
+                else:
+                    user = await (
+                        _user_queryset(restrict_fields).using(primary).aget(pk=uid)
+                    )
+        except (ObjectDoesNotExist, TypeError, ValueError, ValidationError):
+            raise _malformed_code("unknown_user")
+        if timeout:
+            await get_cache().aset(key, user, timeout)
+
+    if timestamp != codec.last_login_timestamp(user, legacy=legacy):
+        raise _used_code()
+    metrics.incr("codes_decoded")
+    return email, user
+
+
+def verify_code(code, max_age=3 * 86400, opaque=None):
+    """
+    Verifies the signature and the format of the code without accessing the
+    database and returns a ``(email, uid)`` tuple; ``uid`` is ``None`` for
+    new users
+
+    Raises the same ``InvalidCode`` exceptions as ``decode``, except that
+    links for existing users are only rejected by ``decode`` if the user
+    does not exist anymore or has logged in since.
+    """
+    email, uid = verify_signature(_signed_code(code, opaque), max_age=max_age)
+    if is_consumed(code):
+        raise _used_code()
+    return email, uid
+
+
+#: Codes are ``<payload>:<timestamp>:<signature>``, the timestamp is base 62
+#: and the signature URL safe base 64 encoded.
+_code_format = re.compile(r"^[^\s\x00-\x1f\x7f]+:[0-9A-Za-z]+:[A-Za-z0-9_-]+$")
+
+
+def verify_signature(code, max_age=3 * 86400):
+    """
+    Checks the length and the characters of ``code`` and verifies its
+    signature and age, using only the CPU (neither the user model, the
+    database nor the token store are accessed). Returns a ``(email, uid)``
+    tuple or raises ``InvalidCode``. ``max_age=None`` skips the age check.
+
+    ``decode`` runs the same checks before loading the user.
     """
+    email, uid, timestamp, legacy = _decode_payload(code, max_age)
+    return email, uid
+
+
+def _invalid_code(reason, message):
+    metrics.incr("decode_failures", reason=reason)
+    return InvalidCode(message, reason=reason)
+
+
+def _malformed_code(reason="malformed"):
+    return _invalid_code(
+        reason,
+        _(
+            "Something went wrong while decoding the"
+            " registration request. Please try again."
+        ),
+    )
+
+
+def _used_code():
+    return _invalid_code("used", _("The link has already been used."))
+
+
+def _expired_code():
+    return _invalid_code(
+        "expired",
+        _("The link is expired. Please request another registration link."),
+    )
+
+
+def _signed_code(code, opaque=None):
+    if opaque is False or (opaque is None and not is_opaque_code(code)):
+        return code
+    if not is_opaque_code(code):
+        raise _malformed_code()
+    # Unknown codes have expired or have never been issued
+    signed = resolve_code(code)
+    if signed is None:
+        raise _expired_code()
+    return signed
+
+
+async def _asigned_code(code, opaque=None):
+    if opaque is False or (opaque is None and not is_opaque_code(code)):
+        return code
+    if not is_opaque_code(code):
+        raise _malformed_code()
+    signed = await aresolve_code(code)
+    if signed is None:
+        raise _expired_code()
+    return signed
+
+
+def _decode_payload(code, max_age):
+    # Garbage does not even have to be hashed
+    if len(code) > getattr(
+        settings, "EMAIL_REGISTRATION_MAX_CODE_LENGTH", 512
+    ) or not _code_format.match(code):
+        raise _malformed_code()
     try:
-        data = get_signer().unsign(code, max_age=max_age)
+        with metrics.timed("unsign"):
+            data = unsign(code, max_age=max_age)
     except signing.SignatureExpired:
-        raise InvalidCode(
-            _("The link is expired. Please request another registration link.")
-        )
+        raise _expired_code()
 
     except signing.BadSignature:
-        raise InvalidCode(
+        raise _invalid_code(
+            "bad_signature",
             _(
                 "Unable to verify the signature. Please request a new"
                 " registration link."
-            )
+            ),
         )
 
-    parts = data.rsplit(":", 2)
-    if len(parts) != 3:
-        raise InvalidCode(
-            _(
-                "Something went wrong while decoding the"
-                " registration request. Please try again."
-            )
-        )
+    try:
+        return codec.loads(data)
+    except ValueError:
+        raise _malformed_code()
 
-    email, uid, timestamp = parts
-    if uid and timestamp:
-        try:
-            user = User.objects.get(pk=uid)
-        except (User.DoesNotExist, TypeError, ValueError):
-            raise InvalidCode(
-                _(
-                    "Something went wrong while decoding the"
-                    " registration request. Please try again."
-                )
-            )
 
-        if timestamp != int_to_base36(get_last_login_timestamp(user)):
-            raise InvalidCode(_("The link has already been used."))
+def get_user_database(write=False):
+    """
+    Returns the database alias users are read from
+    (``EMAIL_REGISTRATION_READ_DATABASE``, e.g. a replica) or written to
+    (``EMAIL_REGISTRATION_WRITE_DATABASE``). The database routers decide if
+    the setting is not set.
+    """
+    model = get_user_model_info().model
+    if write:
+        return getattr(
+            settings, "EMAIL_REGISTRATION_WRITE_DATABASE", None
+        ) or router.db_for_write(model)
+    return getattr(settings, "EMAIL_REGISTRATION_READ_DATABASE", None) or (
+        router.db_for_read(model)
+    )
 
-    else:
-        user = None
 
-    return email, user
+def _read_databases(using):
+    # Users which have just been created may not have been replicated yet,
+    # the write database has the final say.
+    using = using or get_user_database()
+    write = get_user_database(write=True)
+    return [using] if using == write else [using, write]
+
+
+def _user_queryset(restrict_fields):
+    info = get_user_model_info()
+    queryset = info.model._default_manager.all()
+    if restrict_fields:
+        queryset = queryset.only(*info.restricted_fields)
+    return queryset
+
+
+def _decode_cache_key(code, restrict_fields):
+    return "email_registration:decode:%s:%s" % (
+        hashlib.sha256(code.encode()).hexdigest(),
+        int(bool(restrict_fields)),
+    )
+
+
+def forget_code(code):
+    """
+    Removes the user instance cached by ``decode`` for ``code``, e.g. after
+    the password has been set
+    """
+    if getattr(settings, "EMAIL_REGISTRATION_DECODE_CACHE_TIMEOUT", 0):
+        get_cache().delete_many(
+            [_decode_cache_key(code, False), _decode_cache_key(code, True)]
+        )
+
+
+async def aforget_code(code):
+    """
+    Async version of ``forget_code``
+    """
+    if getattr(settings, "EMAIL_REGISTRATION_DECODE_CACHE_TIMEOUT", 0):
+        await get_cache().adelete_many(
+            [_decode_cache_key(code, False), _decode_cache_key(code, True)]
+        )
 
 
 def render_to_mail(template, context, **kwargs):
@@ -158,23 +803,165 @@ def render_to_mail(template, context, **kwargs):
         message = render_to_mail('myproject/hello_mail', {}, to=[email])
         message.send()
     """
-    lines = iter(render_to_string("%s.txt" % template, context).splitlines())
+    with metrics.timed("render"):
+        prerendered = (
+            get_prerendered_mail(template, context)
+            if getattr(settings, "EMAIL_REGISTRATION_PRERENDER_MAIL", False)
+            else None
+        )
+        if prerendered is not None:
+            txt, html = prerendered
+            subject, body = split_subject(_substitute(txt, context))
+            message = EmailMultiAlternatives(subject=subject, body=body, **kwargs)
+            if html is not None:
+                message.attach_alternative(_substitute(html, context), "text/html")
+            return message
+
+        txt, html = get_mail_templates(template)
+        subject, body = split_subject(txt.render(context))
+        message = EmailMultiAlternatives(subject=subject, body=body, **kwargs)
+        if html is not None:
+            message.attach_alternative(html.render(context), "text/html")
+    return message
+
+
+_mail_templates = {}
 
-    subject = ""
-    while True:
-        line = next(lines)
-        if line:
-            subject = line
-            break
 
-    body = "\n".join(lines).strip("\n")
-    message = EmailMultiAlternatives(subject=subject, body=body, **kwargs)
+def get_mail_templates(template):
+    """
+    Returns a ``(txt, html)`` tuple of compiled templates for the mail base
+    name ``template``; ``html`` is ``None`` if no HTML version exists
 
+    The result is remembered per base name so that neither the template
+    loaders nor the lookup of a missing HTML template run again for every mail.
+    The cache is cleared when a file changes while using the autoreloader
+    and can be disabled using ``EMAIL_REGISTRATION_CACHE_TEMPLATES = False``.
+    """
     try:
-        message.attach_alternative(
-            render_to_string("%s.html" % template, context), "text/html"
-        )
+        return _mail_templates[template]
+    except KeyError:
+        pass
+
+    txt = get_template("%s.txt" % template)
+    try:
+        html = get_template("%s.html" % template)
     except TemplateDoesNotExist:
+        html = None
+
+    if getattr(settings, "EMAIL_REGISTRATION_CACHE_TEMPLATES", True):
+        _mail_templates[template] = (txt, html)
+    return txt, html
+
+
+_prerendered_mails = {}
+
+
+def get_prerendered_mail(template, context):
+    """
+    Returns the text and HTML version of the mail ``template`` rendered once
+    per active language, split into static parts and the positions where the
+    (string) values of ``context`` are inserted, or ``None`` if the template
+    cannot be rendered that way
+
+    The templates are rendered twice using different placeholders for each
+    value. The mail is only pre-rendered if both results are equal apart
+    from the placeholders, so templates which do anything else than output
+    the values (e.g. apply filters or compare them) are always rendered
+    completely. Whether a value has been escaped is detected by looking for
+    the escaped or the raw version of the placeholder.
+
+    Enabled using ``EMAIL_REGISTRATION_PRERENDER_MAIL = True``. Templates
+    using tags such as ``{% now %}`` should not be pre-rendered.
+    """
+    if not isinstance(context, dict) or not all(
+        isinstance(value, str) for value in context.values()
+    ):
+        return None
+
+    key = (template, get_language(), tuple(sorted(context)))
+    try:
+        return _prerendered_mails[key]
+    except KeyError:
         pass
 
-    return message
+    txt, html = get_mail_templates(template)
+    result = _prerender(txt, key[2])
+    if result is not None and html is not None:
+        html = _prerender(html, key[2])
+        result = None if html is None else (result, html)
+    elif result is not None:
+        result = (result, None)
+
+    if getattr(settings, "EMAIL_REGISTRATION_CACHE_TEMPLATES", True):
+        _prerendered_mails[key] = result
+    return result
+
+
+def _prerender(template, names, context=None, request=None):
+    renders = []
+    for nonce in (get_random_string(12), get_random_string(12)):
+        # The ampersand differs between the escaped and the raw placeholder
+        placeholders = {name: "\x1e%s:%s&\x1e" % (nonce, name) for name in names}
+        lookup = {}
+        for name, placeholder in placeholders.items():
+            lookup[placeholder] = (name, False)
+            lookup[conditional_escape(placeholder)] = (name, True)
+        pattern = re.compile("|".join(re.escape(ph) for ph in lookup))
+        text = template.render({**(context or {}), **placeholders}, request)
+
+        parts, start = [], 0
+        for match in pattern.finditer(text):
+            parts.append(text[start : match.start()])
+            parts.append(lookup[match.group()])
+            start = match.end()
+        parts.append(text[start:])
+        renders.append(parts)
+
+    if renders[0] != renders[1] or "\x1e" in "".join(
+        part for part in renders[0] if isinstance(part, str)
+    ):
+        return None
+    return tuple(renders[0])
+
+
+def _substitute(parts, context):
+    result = []
+    for part in parts:
+        if isinstance(part, str):
+            result.append(part)
+        elif part[1]:
+            result.append(conditional_escape(context[part[0]]))
+        else:
+            result.append(context[part[0]])
+    return "".join(result)
+
+
+@receiver(file_changed)
+@receiver(setting_changed)
+def _clear_mail_templates(setting=None, **kwargs):
+    if setting in {None, "TEMPLATES", "EMAIL_REGISTRATION_CACHE_TEMPLATES"}:
+        _mail_templates.clear()
+    if setting in {
+        None,
+        "TEMPLATES",
+        "LANGUAGES",
+        "EMAIL_REGISTRATION_CACHE_TEMPLATES",
+        "EMAIL_REGISTRATION_PRERENDER_MAIL",
+    }:
+        _prerendered_mails.clear()
+
+
+_unusual_line_breaks = re.compile("[\r\v\f\x1c-\x1e\x85\u2028\u2029]")
+
+
+def split_subject(text):
+    """
+    Splits a rendered mail into the subject (the first non-empty line) and
+    the body (everything after the subject, without leading and trailing
+    empty lines)
+    """
+    if _unusual_line_breaks.search(text):
+        text = "\n".join(text.splitlines())
+    subject, _sep, body = text.lstrip("\n").partition("\n")
+    return subject, body.strip("\n")
@@ -1,22 +1,72 @@
+import json
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django import forms
+from django.conf import settings
 from django.contrib import messages
-from django.contrib.auth import get_user_model
-from django.contrib.auth.forms import SetPasswordForm
-from django.core.exceptions import FieldDoesNotExist
+from django.http import HttpResponseNotFound, JsonResponse
 from django.shortcuts import redirect, render
+from django.utils.cache import patch_cache_control
 from django.utils.crypto import get_random_string
 from django.utils.translation import gettext as _, gettext_lazy
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
+
+from email_registration import metrics
+from email_registration.normalization import normalize_email
+from email_registration.opaque import is_opaque_code
+from email_registration.pages import arender_page, form_state, render_page
+from email_registration.signals import asend_password_set, send_password_set
+from email_registration.throttling import (
+    aforget_duplicate,
+    ais_duplicate,
+    ais_throttled,
+    forget_duplicate,
+    is_duplicate,
+    is_throttled,
+)
+from email_registration.tokens import (
+    aconsume_code,
+    arelease_code,
+    consume_code,
+    release_code,
+)
+from email_registration.utils import (
+    InvalidCode,
+    adecode,
+    aforget_code,
+    asend_registration_mail,
+    decode,
+    forget_code,
+    get_user_database,
+    get_user_model_info,
+    send_registration_mail,
+    verify_code,
+    verify_signature,
+)
+
 
-from email_registration.signals import password_set
-from email_registration.utils import InvalidCode, decode, send_registration_mail
+def __getattr__(name):
+    # Importing this module should not require the app registry, therefore
+    # the user model is only resolved when it is needed.
+    if name == "User":
+        return get_user_model_info().model
+    if name == "USERNAME_FIELD":
+        return get_user_model_info().model.USERNAME_FIELD
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
-User = get_user_model()
-USERNAME_FIELD = User.USERNAME_FIELD
+EMAIL_EXISTS_MESSAGE = gettext_lazy(
+    "This email address already exists as an account."
+    " Did you want to reset your password?"
+)
 
 
 class RegistrationForm(forms.Form):
+    #: The async view sets this to ``False`` and checks for existing accounts
+    #: using the async ORM after validating the form.
+    check_existing = True
+
     email = forms.EmailField(
         label=gettext_lazy("email address"),
         max_length=75,
@@ -29,26 +79,136 @@ class RegistrationForm(forms.Form):
 
     def clean_email(self):
         email = self.cleaned_data.get("email")
-        if email and User.objects.filter(email=email).exists():
-            raise forms.ValidationError(
-                _(
-                    "This email address already exists as an account."
-                    " Did you want to reset your password?"
-                )
-            )
+        if not email:
+            return email
+        email = normalize_email(email)
+        if self.check_existing:
+            with metrics.timed("exists_query"):
+                exists = _users_with_email(email).exists()
+            if exists:
+                raise forms.ValidationError(EMAIL_EXISTS_MESSAGE)
         return email
 
 
+def _users_with_email(email, using=None):
+    return (
+        get_user_model_info()
+        .model._default_manager.using(using or get_user_database())
+        .filter(email=email)
+    )
+
+
+def _save_user(form, user):
+    # The user may have been loaded from a replica. Database routers which
+    # do not decide themselves write to the instance's database, so this
+    # routes the write to the primary while still calling form.save() (and
+    # everything a project's form does when committing).
+    user._state.db = get_user_database(write=True)
+    return form.save()
+
+
+def _new_user(email):
+    info = get_user_model_info()
+    username_field = info.username_field
+
+    kwargs = {}
+    if username_field.name == "email":
+        kwargs["email"] = email
+    else:
+        username = email
+
+        # If email exceeds max length of field set username to random
+        # string
+        max_length = username_field.max_length
+        if len(username) > max_length:
+            username = get_random_string(25 if max_length >= 25 else max_length)
+        kwargs[username_field.name] = username
+
+        # Set value for 'email' field in case the user model has one
+        if info.email_field:
+            kwargs[info.email_field] = email
+
+    return info.model(**kwargs)
+
+
+def _set_password_form():
+    # django.contrib.auth.forms imports the auth models.
+    from django.contrib.auth.forms import SetPasswordForm
+
+    return SetPasswordForm
+
+
+def _fast_reject(code):
+    if not getattr(settings, "EMAIL_REGISTRATION_FAST_REJECT", False):
+        return None
+    if is_opaque_code(code):
+        # Only the code store knows
+        return None
+    try:
+        # Expired links are left to the view which tells the user about it
+        verify_signature(code, max_age=None)
+    except InvalidCode as exc:
+        metrics.incr("fast_rejects", reason=exc.reason)
+        response = HttpResponseNotFound(
+            "%s" % exc, content_type="text/plain; charset=utf-8"
+        )
+        patch_cache_control(
+            response,
+            public=True,
+            max_age=getattr(settings, "EMAIL_REGISTRATION_FAST_REJECT_MAX_AGE", 86400),
+        )
+        return response
+    return None
+
+
+def fast_reject(view):
+    """
+    Rejects codes which are malformed or have an invalid signature before
+    ``view`` runs if ``EMAIL_REGISTRATION_FAST_REJECT`` is set
+
+    The check only uses the CPU. The ``404`` response neither touches the
+    session nor the messages framework and may be cached publicly for
+    ``EMAIL_REGISTRATION_FAST_REJECT_MAX_AGE`` seconds. Rejections are
+    counted as ``fast_rejects``, tagged with the ``reason``.
+    """
+    if iscoroutinefunction(view):
+
+        async def wrapper(request, code, *args, **kwargs):
+            return _fast_reject(code) or await view(request, code, *args, **kwargs)
+
+        markcoroutinefunction(wrapper)
+
+    else:
+
+        def wrapper(request, code, *args, **kwargs):
+            return _fast_reject(code) or view(request, code, *args, **kwargs)
+
+    return wraps(view)(wrapper)
+
+
 @require_POST
 def email_registration_form(request, form_class=RegistrationForm):
     # TODO unajaxify this view for the release?
+    if is_throttled(request, request.POST.get("email")):
+        return render(
+            request, "registration/email_registration_throttled.html", status=429
+        )
+
     form = form_class(request.POST)
 
-    if form.is_valid():
+    with metrics.timed("form_validation"):
+        is_valid = form.is_valid()
+
+    if is_valid:
         email = form.cleaned_data["email"]
-        send_registration_mail(email, request)
+        if not is_duplicate(email):
+            try:
+                send_registration_mail(email, request)
+            except Exception:
+                forget_duplicate(email)
+                raise
 
-        return render(
+        return render_page(
             request,
             "registration/email_registration_sent.html",
             {
@@ -65,56 +225,161 @@ def email_registration_form(request, form_class=RegistrationForm):
     )
 
 
-def email_registration_confirm(
-    request, code, max_age=3 * 86400, form_class=SetPasswordForm
-):
+@fast_reject
+def email_registration_confirm(request, code, max_age=3 * 86400, form_class=None):
+    # Checks before writing use the primary database, GET requests may be
+    # answered by a replica.
+    using = get_user_database(write=request.method == "POST")
     try:
-        email, user = decode(code, max_age=max_age)
+        email, user = decode(code, max_age=max_age, using=using)
     except InvalidCode as exc:
         messages.error(request, "%s" % exc)
         return redirect("/")
 
     if not user:
-        if User.objects.filter(email=email).exists():
-            messages.error(
-                request,
-                _(
-                    "This email address already exists as an account."
-                    " Did you want to reset your password?"
-                ),
-            )
+        email = normalize_email(email)
+        if _users_with_email(email, using=using).exists():
+            messages.error(request, "%s" % EMAIL_EXISTS_MESSAGE)
             return redirect("/")
 
-        username_field = User._meta.get_field(USERNAME_FIELD)
+        user = _new_user(email)
+
+    form_class = form_class or _set_password_form()
+    if request.method == "POST":
+        form = form_class(user, request.POST)
+        if form.is_valid():
+            # Concurrent requests with the same code are rejected here if a
+            # token store is configured.
+            if not consume_code(code, max_age):
+                messages.error(request, _("The link has already been used."))
+                return redirect("/")
+            try:
+                user = _save_user(form, user)
+            except Exception:
+                release_code(code)
+                raise
+            forget_code(code)
+
+            send_password_set(
+                sender=user.__class__,
+                request=request,
+                user=user,
+                password=form.cleaned_data.get("new_password1"),
+            )
+
+            messages.success(
+                request, _("Successfully set the new password. Please login now.")
+            )
+
+            return redirect("login")
+
+    else:
+        messages.success(request, _("Please set a password."))
+        form = form_class(user)
+
+    return render_page(
+        request,
+        "registration/password_set_form.html",
+        {
+            "form": form,
+        },
+        key=form_state(form),
+    )
+
+
+@require_POST
+async def aemail_registration_form(request, form_class=RegistrationForm):
+    """
+    Async version of ``email_registration_form``
+    """
+    if await ais_throttled(request, request.POST.get("email")):
+        return render(
+            request, "registration/email_registration_throttled.html", status=429
+        )
+
+    form = form_class(request.POST)
+    form.check_existing = False
+
+    with metrics.timed("form_validation"):
+        is_valid = form.is_valid()
+
+    if is_valid:
+        email = form.cleaned_data["email"]
+        with metrics.timed("exists_query"):
+            exists = await _users_with_email(email).aexists()
+        if exists:
+            form.add_error("email", EMAIL_EXISTS_MESSAGE)
 
-        kwargs = {}
-        if username_field.name == "email":
-            kwargs["email"] = email
         else:
-            username = email
+            if not await ais_duplicate(email):
+                try:
+                    await asend_registration_mail(email, request)
+                except Exception:
+                    await aforget_duplicate(email)
+                    raise
 
-            # If email exceeds max length of field set username to random
-            # string
-            max_length = username_field.max_length
-            if len(username) > max_length:
-                username = get_random_string(25 if max_length >= 25 else max_length)
-            kwargs[username_field.name] = username
+            return await arender_page(
+                request,
+                "registration/email_registration_sent.html",
+                {
+                    "email": email,
+                },
+            )
 
-            # Set value for 'email' field in case the user model has one
-            try:
-                User._meta.get_field("email")
-                kwargs["email"] = email
-            except FieldDoesNotExist:
-                pass
+    return render(
+        request,
+        "registration/email_registration_form.html",
+        {
+            "form": form,
+        },
+    )
+
+
+@fast_reject
+async def aemail_registration_confirm(
+    request, code, max_age=3 * 86400, form_class=None
+):
+    """
+    Async version of ``email_registration_confirm``
+
+    Receivers of ``password_set`` are called using ``Signal.asend``.
+    """
+    using = get_user_database(write=request.method == "POST")
+    try:
+        email, user = await adecode(code, max_age=max_age, using=using)
+    except InvalidCode as exc:
+        messages.error(request, "%s" % exc)
+        return redirect("/")
 
-        user = User(**kwargs)
+    if not user:
+        email = normalize_email(email)
+        if await _users_with_email(email, using=using).aexists():
+            messages.error(request, "%s" % EMAIL_EXISTS_MESSAGE)
+            return redirect("/")
+
+        user = _new_user(email)
 
+    form_class = form_class or _set_password_form()
     if request.method == "POST":
+        # Password validators may access fields deferred by
+        # EMAIL_REGISTRATION_RESTRICT_USER_FIELDS, which would run sync
+        # queries otherwise.
+        deferred = user.get_deferred_fields()
+        if deferred:
+            await user.arefresh_from_db(fields=deferred)
         form = form_class(user, request.POST)
         if form.is_valid():
-            user = form.save()
+            if not await aconsume_code(code, max_age):
+                messages.error(request, _("The link has already been used."))
+                return redirect("/")
+            try:
+                user = await sync_to_async(_save_user)(form, user)
+            except Exception:
+                await arelease_code(code)
+                raise
+            await aforget_code(code)
 
-            password_set.send(
+            await asend_password_set(
                 sender=user.__class__,
                 request=request,
                 user=user,
@@ -131,10 +396,117 @@ def email_registration_confirm(
         messages.success(request, _("Please set a password."))
         form = form_class(user)
 
-    return render(
+    return await arender_page(
         request,
         "registration/password_set_form.html",
         {
             "form": form,
         },
+        key=form_state(form),
+    )
+
+
+def _api_data(request):
+    if request.content_type == "application/json":
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return request.POST
+
+
+def _api_error(error, message, status=400):
+    return JsonResponse({"error": error, "message": "%s" % message}, status=status)
+
+
+def _api_form_errors(form):
+    return JsonResponse(
+        {"error": "invalid", "errors": form.errors.get_json_data()}, status=400
+    )
+
+
+@require_POST
+def email_registration_api_form(request, form_class=RegistrationForm):
+    """
+    JSON version of ``email_registration_form``
+
+    Accepts form encoded or JSON data and responds with
+    ``{"email": ...}`` after sending the mail. Neither the messages
+    framework nor the session is used by the JSON views.
+    """
+    data = _api_data(request)
+    if data is None:
+        return _api_error("bad_request", _("Invalid JSON."))
+    if is_throttled(request, data.get("email")):
+        return _api_error("throttled", _("Too many registration requests."), status=429)
+
+    form = form_class(data)
+    with metrics.timed("form_validation"):
+        is_valid = form.is_valid()
+    if not is_valid:
+        return _api_form_errors(form)
+
+    email = form.cleaned_data["email"]
+    if not is_duplicate(email):
+        try:
+            send_registration_mail(email, request)
+        except Exception:
+            forget_duplicate(email)
+            raise
+    return JsonResponse({"email": email})
+
+
+@require_GET
+def email_registration_api_validate(request, code, max_age=3 * 86400):
+    """
+    Verifies the signature of ``code`` without accessing the database and
+    responds with ``{"email": ..., "existing_user": ...}``
+    """
+    try:
+        email, uid = verify_code(code, max_age=max_age)
+    except InvalidCode as exc:
+        return _api_error(exc.reason, exc)
+    return JsonResponse({"email": email, "existing_user": uid is not None})
+
+
+@require_POST
+def email_registration_api_confirm(request, code, max_age=3 * 86400, form_class=None):
+    """
+    JSON version of ``email_registration_confirm``, only accepting the POST
+    request setting the password
+    """
+    data = _api_data(request)
+    if data is None:
+        return _api_error("bad_request", _("Invalid JSON."))
+    using = get_user_database(write=True)
+    try:
+        email, user = decode(code, max_age=max_age, using=using)
+    except InvalidCode as exc:
+        return _api_error(exc.reason, exc)
+
+    if not user:
+        email = normalize_email(email)
+        if _users_with_email(email, using=using).exists():
+            return _api_error("exists", EMAIL_EXISTS_MESSAGE)
+        user = _new_user(email)
+
+    form = (form_class or _set_password_form())(user, data)
+    if not form.is_valid():
+        return _api_form_errors(form)
+    if not consume_code(code, max_age):
+        return _api_error("used", _("The link has already been used."))
+    try:
+        user = _save_user(form, user)
+    except Exception:
+        release_code(code)
+        raise
+    forget_code(code)
+
+    send_password_set(
+        sender=user.__class__,
+        request=request,
+        user=user,
+        password=form.cleaned_data.get("new_password1"),
     )
+    return JsonResponse({"email": email})
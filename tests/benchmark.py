@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+Benchmarks for django-email-registration
+
+Run from the ``tests`` folder::
+
+    ./benchmark.py                        # all benchmarks, 10k users
+    ./benchmark.py render_to_mail decode  # selected benchmarks
+    ./benchmark.py --users 1000000 --json results.json
+
+The benchmarks run against an in-memory SQLite database seeded with
+``--users`` rows and the locmem mail backend. Results are printed as a table
+and optionally written as JSON (``--json``, ``-`` for stdout) so that they
+can be compared across releases.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+from itertools import count
+from os.path import abspath, dirname
+
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def measure(fn, number=1000, repeat=5):
+    """
+    Returns the best operations/second of ``repeat`` runs and the number of
+    queries a single call executes
+    """
+    from django.db import connection
+
+    queries = []
+
+    def count_queries(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count_queries):
+        fn()
+    return {
+        "ops_per_sec": number / min(timeit.repeat(fn, number=number, repeat=repeat)),
+        "queries": len(queries),
+    }
+
+
+def _emails(prefix):
+    return ("%s-%s@example.org" % (prefix, i) for i in count())
+
+
+@benchmark
+def get_confirmation_url():
+    from django.contrib.auth import get_user_model
+
+    from email_registration.utils import get_confirmation_url
+
+    user = get_user_model().objects.order_by("-pk")[0]
+    yield "new_user", measure(
+        lambda: get_confirmation_url("test@example.com", "http://testserver")
+    )
+    yield "existing_user", measure(
+        lambda: get_confirmation_url(user.email, "http://testserver", user=user)
+    )
+
+
+@benchmark
+def decode():
+    from django.contrib.auth import get_user_model
+
+    from email_registration.codec import dumps
+    from email_registration.utils import decode, get_signer
+
+    user = get_user_model().objects.order_by("-pk")[0]
+    new_code = get_signer().sign(dumps("test@example.com"))
+    existing_code = get_signer().sign(dumps(user.email, user))
+
+    yield "new_user", measure(lambda: decode(new_code))
+    yield "existing_user", measure(lambda: decode(existing_code))
+
+
+@benchmark
+def sign_unsign():
+    from django.core import signing
+
+    from email_registration.utils import get_signer
+
+    payload = "test@example.com!1!sdf4k2"
+
+    def uncached():
+        signer = signing.TimestampSigner(salt="email_registration")
+        signer.unsign(signer.sign(payload), max_age=3600)
+
+    yield "uncached-sha256", measure(uncached)
+    for algorithm in ("sha256", "blake2b"):
+        signer = get_signer(algorithm=algorithm)
+        yield "cached-%s" % algorithm, measure(
+            lambda: signer.unsign(signer.sign(payload), max_age=3600)
+        )
+
+
+@benchmark
+def render_to_mail():
+    from django.test import override_settings
+
+    from email_registration.utils import render_to_mail
+
+    def render():
+        render_to_mail(
+            "registration/email_registration_email",
+            {"url": "http://testserver/er/test@example.com:abc:def/"},
+            to=["test@example.com"],
+        )
+
+    for cached in (False, True):
+        with override_settings(EMAIL_REGISTRATION_CACHE_TEMPLATES=cached):
+            yield "cached" if cached else "uncached", measure(render)
+    with override_settings(EMAIL_REGISTRATION_PRERENDER_MAIL=True):
+        yield "prerendered", measure(render)
+
+
+@benchmark
+def registration_form():
+    from django.core import mail
+    from django.test import Client
+
+    client = Client()
+    emails = _emails("form")
+
+    def post():
+        client.post("/er/", {"email": next(emails)})
+        mail.outbox = []
+
+    yield "post", measure(post, number=200)
+
+
+@benchmark
+def password_form():
+    from django.test import Client, override_settings
+
+    from email_registration.utils import get_confirmation_url
+
+    client = Client()
+    url = get_confirmation_url("test@example.com", "http://testserver")
+
+    for cached in (False, True):
+        with override_settings(EMAIL_REGISTRATION_CACHE_PAGES=cached):
+            yield "cached" if cached else "uncached", measure(lambda: client.get(url))
+
+
+@benchmark
+def registration_confirm():
+    from django.core import mail
+    from django.test import Client, override_settings
+
+    from email_registration.utils import get_confirmation_url
+
+    client = Client()
+    emails = _emails("confirm")
+
+    def get_and_post():
+        url = get_confirmation_url(next(emails), "http://testserver")
+        client.get(url)
+        client.post(url, {"new_password1": "pass", "new_password2": "pass"})
+        mail.outbox = []
+
+    # Password hashing would dominate the measurement otherwise.
+    with override_settings(
+        PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"]
+    ):
+        yield "get_post", measure(get_and_post, number=100)
+
+
+def seed_users(count, batch_size=10000):
+    from django.contrib.auth import get_user_model
+
+    User = get_user_model()
+    for start in range(0, count, batch_size):
+        User.objects.bulk_create(
+            User(
+                username="user-%s" % i,
+                email="user-%s@example.com" % i,
+                password="!",
+            )
+            for i in range(start, min(start + batch_size, count))
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "names", nargs="*", help="Benchmarks to run: %s" % ", ".join(BENCHMARKS)
+    )
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--json", metavar="FILE")
+    options = parser.parse_args(argv)
+    unknown = set(options.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testapp.settings")
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+    import django
+
+    django.setup()
+
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    call_command("migrate", verbosity=0)
+    seed_users(options.users)
+
+    results = []
+    for name in options.names or BENCHMARKS:
+        for variant, result in BENCHMARKS[name]():
+            results.append({"name": name, "variant": variant, **result})
+            print(
+                "%-24s %-18s %12.0f ops/s %4d queries"
+                % (name, variant, result["ops_per_sec"], result["queries"]),
+                file=sys.stderr,
+            )
+
+    if options.json:
+        data = {
+            "environment": {
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "email_registration": __import__("email_registration").__version__,
+                "users": options.users,
+            },
+            "results": results,
+        }
+        if options.json == "-":
+            json.dump(data, sys.stdout, indent=2)
+        else:
+            with open(options.json, "w") as f:
+                json.dump(data, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+from django.db import models
+
+
+class AuditEntry(models.Model):
+    email_hash = models.CharField(max_length=32)
+    user_id = models.IntegerField(null=True)
+    issued_at = models.DateTimeField()
+    status = models.CharField(max_length=10)
@@ -0,0 +1,131 @@
+from urllib.parse import unquote
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.test import TestCase, override_settings
+
+from email_registration.utils import get_cache, get_confirmation_url
+
+
+def _code(url):
+    return url.rstrip("/").rsplit("/", 1)[-1]
+
+
+class APITest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    def test_registration(self):
+        with self.assertNumQueries(1):
+            response = self.client.post(
+                "/api/er/",
+                {"email": " test@example.com "},
+                content_type="application/json",
+            )
+        self.assertEqual(response.json(), {"email": "test@example.com"})
+        self.assertNotIn("sessionid", response.cookies)
+        self.assertNotIn("messages", response.cookies)
+
+        code = _code(
+            unquote(
+                [
+                    line
+                    for line in mail.outbox[0].body.splitlines()
+                    if "testserver" in line
+                ][0]
+            )
+        )
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/er/%s/validate/" % code)
+        self.assertEqual(
+            response.json(), {"email": "test@example.com", "existing_user": False}
+        )
+
+        # Exists check and insert
+        with self.assertNumQueries(2):
+            response = self.client.post(
+                "/api/er/%s/" % code,
+                {"new_password1": "pass", "new_password2": "pass"},
+                content_type="application/json",
+            )
+        self.assertEqual(response.json(), {"email": "test@example.com"})
+        self.assertNotIn("sessionid", response.cookies)
+        self.assertNotIn("messages", response.cookies)
+        self.assertTrue(
+            User.objects.get(email="test@example.com").check_password("pass")
+        )
+
+        response = self.client.post(
+            "/api/er/%s/" % code, {"new_password1": "pass", "new_password2": "pass"}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "exists")
+
+        with self.assertNumQueries(1):
+            response = self.client.post("/api/er/", {"email": "test@example.com"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.json()["errors"]), ["email"])
+
+    def test_existing_user(self):
+        user = User.objects.create_user("test", "test@example.com", "old")
+        code = _code(get_confirmation_url(user.email, "http://testserver", user=user))
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/er/%s/validate/" % code)
+        self.assertEqual(
+            response.json(), {"email": "test@example.com", "existing_user": True}
+        )
+
+        with self.assertNumQueries(1):
+            response = self.client.post(
+                "/api/er/%s/" % code,
+                {"new_password1": "pass", "new_password2": "other"},
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.json()["errors"]), ["new_password2"])
+
+        # User query and update
+        with self.assertNumQueries(2):
+            response = self.client.post(
+                "/api/er/%s/" % code,
+                {"new_password1": "pass", "new_password2": "pass"},
+            )
+        self.assertEqual(response.status_code, 200)
+        user.refresh_from_db()
+        self.assertTrue(user.check_password("pass"))
+
+    def test_invalid(self):
+        code = _code(get_confirmation_url("test@example.com", "http://testserver"))
+
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                "/api/er/%s/validate/" % code.replace("test", "evil")
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "bad_signature")
+
+        response = self.client.post(
+            "/api/er/%s/" % code, "{", content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "bad_request")
+
+        self.assertEqual(self.client.get("/api/er/").status_code, 405)
+        self.assertEqual(self.client.get("/api/er/%s/" % code).status_code, 405)
+
+    @override_settings(EMAIL_REGISTRATION_RATE_LIMITS={"email": (1, 60)})
+    def test_throttled(self):
+        self.client.post("/api/er/", {"email": "test@example.com"})
+        response = self.client.post("/api/er/", {"email": "test@example.com"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()["error"], "throttled")
+
+    @override_settings(EMAIL_REGISTRATION_RATE_LIMITS={"email": (1, 60)})
+    def test_throttled_invalid_value(self):
+        for email in [5, ["test@example.com"], None]:
+            response = self.client.post(
+                "/api/er/", {"email": email}, content_type="application/json"
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["error"], "invalid")
@@ -0,0 +1,162 @@
+import asyncio
+from unittest import mock
+from urllib.parse import unquote
+
+from django.contrib.auth.forms import SetPasswordForm
+from django.contrib.auth.models import User
+from django.core import mail
+from django.test import TestCase, override_settings
+
+from email_registration.signals import password_set
+from email_registration.utils import get_confirmation_url
+from email_registration.views import (
+    aemail_registration_confirm,
+    aemail_registration_form,
+)
+
+
+def _messages(response):
+    return [m.message for m in response.context["messages"]]
+
+
+# The sync implementations must not be used by the async views; the sync ORM
+# would raise SynchronousOnlyOperation inside the event loop anyway.
+@mock.patch("email_registration.views.decode", side_effect=AssertionError)
+@mock.patch("email_registration.views.is_throttled", side_effect=AssertionError)
+@mock.patch("email_registration.views.is_duplicate", side_effect=AssertionError)
+@mock.patch(
+    "email_registration.views.send_registration_mail", side_effect=AssertionError
+)
+class AsyncRegistrationTest(TestCase):
+    def test_views_are_async(self, *mocks):
+        self.assertTrue(asyncio.iscoroutinefunction(aemail_registration_form))
+        self.assertTrue(asyncio.iscoroutinefunction(aemail_registration_confirm))
+
+    async def test_registration(self, *mocks):
+        received = []
+
+        async def receiver(sender, user, **kwargs):
+            received.append(user)
+
+        password_set.connect(receiver)
+        self.addCleanup(password_set.disconnect, receiver)
+
+        response = await self.async_client.post(
+            "/er-async/", {"email": "test@example.com"}
+        )
+        self.assertContains(response, "We sent you an email to test@example.com.")
+
+        self.assertEqual(len(mail.outbox), 1)
+        url = unquote(
+            [line for line in mail.outbox[0].body.splitlines() if "testserver" in line][
+                0
+            ]
+        ).replace("/er/", "/er-async/")
+
+        response = await self.async_client.get(url)
+        self.assertContains(response, 'id="id_new_password2"')
+
+        response = await self.async_client.post(
+            url, {"new_password1": "pass", "new_password2": "pass"}, follow=True
+        )
+        self.assertRedirects(response, "/ac/login/")
+
+        user = await User.objects.aget()
+        self.assertEqual(user.email, "test@example.com")
+        self.assertTrue(user.check_password("pass"))
+        self.assertEqual(received, [user])
+
+        response = await self.async_client.post(
+            "/er-async/", {"email": "test@example.com"}
+        )
+        self.assertContains(response, "Did you want to reset your password?")
+
+        response = await self.async_client.get(url, follow=True)
+        self.assertEqual(
+            _messages(response),
+            [
+                "This email address already exists as an account."
+                " Did you want to reset your password?"
+            ],
+        )
+
+    async def test_existing_user(self, *mocks):
+        user = await User.objects.acreate(username="test")
+        url = get_confirmation_url(
+            "test@example.com", "http://testserver", user=user
+        ).replace("/er/", "/er-async/")
+
+        response = await self.async_client.post(
+            url, {"new_password1": "pass", "new_password2": "pass"}, follow=True
+        )
+        self.assertRedirects(response, "/ac/login/")
+        await user.arefresh_from_db()
+        self.assertTrue(user.check_password("pass"))
+
+        response = await self.async_client.get(url.replace("com!", "ch!"), follow=True)
+        self.assertEqual(
+            _messages(response),
+            [
+                "Unable to verify the signature."
+                " Please request a new registration link."
+            ],
+        )
+
+    @override_settings(
+        EMAIL_REGISTRATION_RESTRICT_USER_FIELDS=True,
+        AUTH_PASSWORD_VALIDATORS=[
+            {
+                "NAME": "django.contrib.auth.password_validation"
+                ".UserAttributeSimilarityValidator"
+            }
+        ],
+    )
+    async def test_restricted_fields(self, *mocks):
+        user = await User.objects.acreate(username="test", first_name="Firstname")
+        url = get_confirmation_url(
+            "test@example.com", "http://testserver", user=user
+        ).replace("/er/", "/er-async/")
+
+        response = await self.async_client.post(
+            url, {"new_password1": "Firstname", "new_password2": "Firstname"}
+        )
+        self.assertContains(response, "too similar")
+
+        response = await self.async_client.post(
+            url, {"new_password1": "pass", "new_password2": "pass"}
+        )
+        self.assertRedirects(response, "/ac/login/", fetch_redirect_response=False)
+
+    async def test_form_save(self, *mocks):
+        url = get_confirmation_url("test@example.com", "http://testserver").replace(
+            "/er/", "/er-async/"
+        )
+        with mock.patch.object(
+            SetPasswordForm, "save", autospec=True, side_effect=SetPasswordForm.save
+        ) as save:
+            response = await self.async_client.post(
+                url, {"new_password1": "pass", "new_password2": "pass"}
+            )
+        self.assertRedirects(response, "/ac/login/", fetch_redirect_response=False)
+        # Forms overriding save() still see commit=True
+        self.assertEqual(save.call_args.kwargs, {})
+        user = await User.objects.aget()
+        self.assertEqual(user.email, "test@example.com")
+        self.assertTrue(user.check_password("pass"))
+
+    @override_settings(
+        EMAIL_REGISTRATION_RATE_LIMITS={"ip": (2, 60)},
+        EMAIL_REGISTRATION_DEDUPLICATE_TIMEOUT=60,
+    )
+    async def test_throttling(self, *mocks):
+        for i in range(2):
+            response = await self.async_client.post(
+                "/er-async/", {"email": "test@example.com"}
+            )
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 1)
+
+        response = await self.async_client.post(
+            "/er-async/", {"email": "test@example.com"}
+        )
+        self.assertEqual(response.status_code, 429)
@@ -0,0 +1,157 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from testapp.models import AuditEntry
+
+from email_registration import audit, metrics, utils
+from email_registration.audit import AuditRecord, get_audit_sink, hash_email
+from email_registration.delivery import get_delivery_backend
+from email_registration.utils import (
+    get_cache,
+    send_registration_mail,
+    send_registration_mails,
+)
+
+
+class AuditTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "audit.jsonl")
+
+        # Only close() writes records unless the test lowers the interval
+        settings = override_settings(
+            EMAIL_REGISTRATION_AUDIT_SINK="email_registration.audit.FileAuditSink",
+            EMAIL_REGISTRATION_AUDIT_OPTIONS={
+                "path": self.path,
+                "flush_interval": 3600,
+            },
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def records(self):
+        get_audit_sink().close()
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_registration(self):
+        response = self.client.post("/er/", {"email": "test@example.com"})
+        self.assertEqual(response.status_code, 200)
+        # Nothing is written while processing the request
+        self.assertFalse(os.path.exists(self.path))
+
+        (record,) = self.records()
+        self.assertEqual(record["email"], hash_email("test@example.com"))
+        self.assertEqual(len(record["email"]), 32)
+        self.assertIsNone(record["user"])
+        self.assertEqual(record["status"], "sent")
+        self.assertAlmostEqual(record["issued"], time.time(), delta=5)
+
+    def test_failed(self):
+        user = User.objects.create_user("test", "test@example.com")
+        with mock.patch("email_registration.utils.get_delivery_backend") as backend:
+            backend.return_value.deliver.side_effect = OSError
+            with self.assertRaises(OSError):
+                send_registration_mail(user.email, "", user=user)
+
+        (record,) = self.records()
+        self.assertEqual(record["user"], user.pk)
+        self.assertEqual(record["status"], "failed")
+
+    @override_settings(
+        EMAIL_REGISTRATION_DELIVERY_BACKEND=(
+            "email_registration.delivery.ThreadPoolDelivery"
+        ),
+        EMAIL_REGISTRATION_DELIVERY_OPTIONS={
+            "workers": 0,
+            "maxsize": 1,
+            "overflow": "drop",
+        },
+        EMAIL_REGISTRATION_METRICS_SINK="email_registration.metrics.MemorySink",
+    )
+    def test_dropped(self):
+        for i in range(3):
+            send_registration_mail("test-%s@example.com" % i, "")
+
+        self.assertEqual(
+            [record["status"] for record in self.records()],
+            ["sent", "dropped", "dropped"],
+        )
+        self.assertEqual(get_delivery_backend().dropped, 2)
+        self.assertEqual(metrics.get_sink().count("mails_sent"), 1)
+        self.assertEqual(metrics.get_sink().count("mails_dropped"), 2)
+
+    def test_bulk(self):
+        user = User.objects.create_user("test", "test@example.com")
+        emails = ["test@example.com", "invalid", "other@example.com"]
+        sign = utils._sign
+        with mock.patch(
+            "email_registration.utils._sign",
+            side_effect=lambda email, user: (
+                sign(email, user) if "@" in email else 1 / 0
+            ),
+        ):
+            list(send_registration_mails(emails, "", users={user.email: user}))
+
+        self.assertEqual(
+            [(record["user"], record["status"]) for record in self.records()],
+            [(user.pk, "sent"), (None, "failed"), (None, "sent")],
+        )
+
+    def test_background(self):
+        with override_settings(
+            EMAIL_REGISTRATION_AUDIT_OPTIONS={"path": self.path, "batch_size": 2}
+        ):
+            audit.record("a@example.com", None, "sent")
+            audit.record("b@example.com", None, "sent")
+            for i in range(100):
+                if os.path.exists(self.path):
+                    break
+                time.sleep(0.05)
+            with open(self.path) as f:
+                self.assertEqual(len(f.readlines()), 2)
+
+    def test_max_buffer(self):
+        with override_settings(
+            EMAIL_REGISTRATION_AUDIT_OPTIONS={
+                "path": self.path,
+                "flush_interval": 3600,
+                "max_buffer": 2,
+            }
+        ):
+            for i in range(5):
+                audit.record("test@example.com", None, "sent")
+            self.assertEqual(get_audit_sink().dropped, 3)
+            self.assertEqual(len(self.records()), 2)
+
+
+@override_settings(
+    EMAIL_REGISTRATION_AUDIT_SINK="email_registration.audit.ModelAuditSink",
+    EMAIL_REGISTRATION_AUDIT_OPTIONS={
+        "model": "testapp.AuditEntry",
+        "flush_interval": 3600,
+        "batch_size": 2,
+    },
+)
+class ModelAuditTest(TestCase):
+    def test_bulk_create(self):
+        sink = get_audit_sink()
+        # Writes in the background thread would use a different connection
+        with mock.patch.object(sink, "_start"):
+            for i in range(5):
+                sink.record(AuditRecord(hash_email("test@example.com"), i, 0, "sent"))
+            with self.assertNumQueries(3):
+                sink.flush()
+        self.assertEqual(
+            list(AuditEntry.objects.order_by("user_id").values_list("user_id")),
+            [(i,) for i in range(5)],
+        )
+        self.assertEqual(AuditEntry.objects.first().issued_at.year, 1970)
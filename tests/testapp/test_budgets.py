@@ -0,0 +1,163 @@
+"""
+Budgets for the database queries, template renders and mail connections of
+each flow. A change adding a round trip has to update the numbers here.
+"""
+
+from contextlib import contextmanager
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail, signing
+from django.core.mail.backends import locmem
+from django.test import TestCase, override_settings
+from django.test.signals import template_rendered
+from django.utils import timezone
+
+from email_registration.utils import get_cache, get_confirmation_url
+
+
+class BudgetTestCase(TestCase):
+    @contextmanager
+    def assertBudget(self, queries, templates, connections=0):
+        rendered = []
+
+        def on_rendered(sender, template, **kwargs):
+            # Form widgets and partials of other apps depend on their versions
+            if not template.name.startswith(("django/", "towel/")):
+                rendered.append(template.name)
+
+        template_rendered.connect(on_rendered)
+        try:
+            with mock.patch.object(
+                locmem.EmailBackend,
+                "__init__",
+                autospec=True,
+                side_effect=locmem.EmailBackend.__init__,
+            ) as opened:
+                with self.assertNumQueries(queries):
+                    yield
+        finally:
+            template_rendered.disconnect(on_rendered)
+
+        self.assertEqual(rendered, templates)
+        self.assertEqual(opened.call_count, connections, "Mail connections")
+
+
+class RegistrationBudgetTest(BudgetTestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    def test_new_registration(self):
+        # Exists check; mail, sent page
+        with self.assertBudget(
+            queries=1,
+            templates=[
+                "registration/email_registration_email.txt",
+                "registration/email_registration_sent.html",
+            ],
+            connections=1,
+        ):
+            response = self.client.post("/er/", {"email": "test@example.com"})
+        self.assertEqual(response.status_code, 200)
+        url = get_confirmation_url("test@example.com", "http://testserver")
+
+        # Exists check; password form
+        with self.assertBudget(
+            queries=1, templates=["registration/password_set_form.html", "base.html"]
+        ):
+            response = self.client.get(url)
+        self.assertContains(response, 'id="id_new_password2"')
+
+        # Exists check and insert
+        with self.assertBudget(queries=2, templates=[]):
+            response = self.client.post(
+                url, {"new_password1": "pass", "new_password2": "pass"}
+            )
+        self.assertRedirects(response, "/ac/login/", fetch_redirect_response=False)
+
+    def test_existing_user(self):
+        user = User.objects.create_user("test", "test@example.com", "old")
+        url = get_confirmation_url(user.email, "http://testserver", user=user)
+
+        with self.assertBudget(
+            queries=1, templates=["registration/password_set_form.html", "base.html"]
+        ):
+            response = self.client.get(url)
+        self.assertContains(response, 'id="id_new_password2"')
+
+        # User query and update
+        with self.assertBudget(queries=2, templates=[]):
+            response = self.client.post(
+                url, {"new_password1": "pass", "new_password2": "pass"}
+            )
+        self.assertRedirects(response, "/ac/login/", fetch_redirect_response=False)
+
+    def test_reused_link(self):
+        user = User.objects.create_user("test", "test@example.com", "old")
+        url = get_confirmation_url(user.email, "http://testserver", user=user)
+        user.last_login = timezone.now()
+        user.save()
+
+        # The user is loaded to compare last_login
+        with self.assertBudget(queries=1, templates=[]):
+            response = self.client.get(url)
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
+
+    def test_expired_link(self):
+        url = get_confirmation_url("test@example.com", "http://testserver")
+        with mock.patch("time.time", return_value=signing.time.time() + 4 * 86400):
+            with self.assertBudget(queries=0, templates=[]):
+                response = self.client.get(url)
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
+
+    def test_invalid_signature(self):
+        url = get_confirmation_url("test@example.com", "http://testserver")
+        with self.assertBudget(queries=0, templates=[]):
+            response = self.client.get(url.replace("test@", "evil@"))
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
+
+    def test_existing_email(self):
+        User.objects.create_user("test", "test@example.com", "old")
+        with self.assertBudget(
+            queries=1, templates=["registration/email_registration_form.html"]
+        ):
+            response = self.client.post("/er/", {"email": "test@example.com"})
+        self.assertContains(response, "Did you want to reset your password?")
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(
+        EMAIL_REGISTRATION_RATE_LIMITS={"ip": (10, 60), "email": (10, 60)},
+        EMAIL_REGISTRATION_DEDUPLICATE_TIMEOUT=60,
+        EMAIL_REGISTRATION_TOKEN_STORE="email_registration.tokens.CacheTokenStore",
+        EMAIL_REGISTRATION_DECODE_CACHE_TIMEOUT=60,
+        EMAIL_REGISTRATION_RESTRICT_USER_FIELDS=True,
+    )
+    def test_cache_backed_features(self):
+        # Throttling, deduplication and consumed codes only use the cache
+        with self.assertBudget(
+            queries=1,
+            templates=[
+                "registration/email_registration_email.txt",
+                "registration/email_registration_sent.html",
+            ],
+            connections=1,
+        ):
+            self.client.post("/er/", {"email": "test@example.com"})
+        # Deduplicated, no mail is rendered or sent
+        with self.assertBudget(
+            queries=1, templates=["registration/email_registration_sent.html"]
+        ):
+            self.client.post("/er/", {"email": "test@example.com"})
+
+        user = User.objects.create_user("test", "other@example.com", "old")
+        url = get_confirmation_url(user.email, "http://testserver", user=user)
+        with self.assertBudget(
+            queries=1, templates=["registration/password_set_form.html", "base.html"]
+        ):
+            self.client.get(url)
+        # The user is cached since the GET request
+        with self.assertBudget(queries=1, templates=[]):
+            self.client.post(url, {"new_password1": "pass", "new_password2": "pass"})
+        with self.assertBudget(queries=0, templates=[]):
+            response = self.client.get(url)
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
@@ -0,0 +1,45 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from email_registration.conf import SettingInstance
+
+
+class Closing:
+    def __init__(self, value=None):
+        self.value = value
+        self.close = mock.Mock()
+
+
+class SettingInstanceTest(SimpleTestCase):
+    def test_instance(self):
+        instance = SettingInstance("TEST_CLASS", "TEST_OPTIONS")
+        self.assertIsNone(instance.get())
+
+        with override_settings(
+            TEST_CLASS="testapp.test_conf.Closing", TEST_OPTIONS={"value": 1}
+        ):
+            first = instance.get()
+            self.assertIs(instance.get(), first)
+            self.assertEqual(first.value, 1)
+
+            with override_settings(TEST_OPTIONS={"value": 2}):
+                self.assertEqual(instance.get().value, 2)
+            self.assertEqual(instance.get().value, 1)
+        self.assertIsNone(instance.get())
+        # Instances are only closed if requested
+        first.close.assert_not_called()
+
+    def test_default_and_close(self):
+        instance = SettingInstance(
+            "TEST_CLASS",
+            "TEST_OPTIONS",
+            default="testapp.test_conf.Closing",
+            close=True,
+        )
+        first = instance.get()
+        self.assertIsInstance(first, Closing)
+        with override_settings(TEST_CLASS=None):
+            first.close.assert_called_once_with()
+            self.assertIsNone(instance.get())
+        self.assertIsInstance(instance.get(), Closing)
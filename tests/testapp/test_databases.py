@@ -0,0 +1,106 @@
+from unittest import mock
+
+from django.contrib.auth.forms import SetPasswordForm
+from django.contrib.auth.models import User
+from django.core import mail
+from django.test import TestCase, override_settings
+
+from email_registration.utils import (
+    InvalidCode,
+    decode,
+    get_cache,
+    get_confirmation_url,
+)
+
+
+# The replica is not a mirror of default; users only created in default
+# simulate replication lag.
+@override_settings(
+    EMAIL_REGISTRATION_READ_DATABASE="replica",
+    EMAIL_REGISTRATION_WRITE_DATABASE="default",
+)
+class DatabaseRoutingTest(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        get_cache().clear()
+
+    def _replicate(self, user):
+        User.objects.using("replica").bulk_create([user])
+
+    def test_decode_from_replica(self):
+        user = User.objects.create_user("test", "test@example.com")
+        self._replicate(user)
+        url = get_confirmation_url(user.email, "", user=user)
+
+        with self.assertNumQueries(1, using="replica"):
+            with self.assertNumQueries(0, using="default"):
+                email, decoded = decode(url.split("/")[-2])
+        self.assertEqual(decoded, user)
+        self.assertEqual(decoded._state.db, "replica")
+
+    def test_decode_lagging_replica(self):
+        user = User.objects.create_user("test", "test@example.com")
+        url = get_confirmation_url(user.email, "", user=user)
+
+        with self.assertNumQueries(1, using="replica"):
+            with self.assertNumQueries(1, using="default"):
+                email, decoded = decode(url.split("/")[-2])
+        self.assertEqual(decoded._state.db, "default")
+
+        User.objects.all().delete()
+        with self.assertRaises(InvalidCode):
+            decode(url.split("/")[-2])
+
+    def test_existing_user(self):
+        user = User.objects.create_user("test", "test@example.com")
+        self._replicate(user)
+        url = get_confirmation_url(user.email, "", user=user)
+
+        with self.assertNumQueries(0, using="default"):
+            response = self.client.get(url)
+        self.assertContains(response, 'id="id_new_password2"')
+
+        # The user has been loaded from the replica, but is saved to default
+        with mock.patch.object(
+            SetPasswordForm, "save", autospec=True, side_effect=SetPasswordForm.save
+        ) as save:
+            response = self.client.post(
+                url, {"new_password1": "pass", "new_password2": "pass"}
+            )
+        # Forms overriding save() still see commit=True
+        self.assertEqual(save.call_args.kwargs, {})
+        self.assertRedirects(response, "/ac/login/", fetch_redirect_response=False)
+        self.assertTrue(User.objects.get().check_password("pass"))
+        self.assertFalse(User.objects.using("replica").get().has_usable_password())
+
+    def test_new_user(self):
+        url = get_confirmation_url("test@example.com", "")
+
+        with self.assertNumQueries(1, using="replica"):
+            with self.assertNumQueries(0, using="default"):
+                self.client.get(url)
+
+        with self.assertNumQueries(0, using="replica"):
+            response = self.client.post(
+                url, {"new_password1": "pass", "new_password2": "pass"}
+            )
+        self.assertRedirects(response, "/ac/login/", fetch_redirect_response=False)
+        self.assertEqual(User.objects.get().email, "test@example.com")
+        self.assertFalse(User.objects.using("replica").exists())
+
+    def test_new_user_lagging_replica(self):
+        # The form only checks the replica and sends the mail, but the
+        # primary database is checked before creating the user.
+        User.objects.create_user("test", "test@example.com")
+
+        response = self.client.post("/er/", {"email": "test@example.com"})
+        self.assertContains(response, "test@example.com")
+        self.assertEqual(len(mail.outbox), 1)
+
+        url = get_confirmation_url("test@example.com", "")
+        response = self.client.post(
+            url, {"new_password1": "pass", "new_password2": "pass"}
+        )
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
+        self.assertEqual(User.objects.count(), 1)
@@ -0,0 +1,432 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from io import StringIO
+from itertools import chain
+from unittest import mock
+from urllib.parse import unquote
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+
+from email_registration.delivery import (
+    QueueFull,
+    SpoolDelivery,
+    ThreadPoolDelivery,
+    drain_spool,
+    get_delivery_backend,
+)
+from email_registration.utils import (
+    render_to_mail,
+    send_registration_mail,
+    send_registration_mails,
+)
+
+
+enqueued = []
+
+
+def enqueue(message):
+    enqueued.append(message)
+
+
+def _message(email="test@example.com"):
+    return render_to_mail(
+        "registration/email_registration_email", {"url": "http://x/"}, to=[email]
+    )
+
+
+class DeliveryTest(TestCase):
+    def test_sync_is_default(self):
+        send_registration_mail("test@example.com", RequestFactory().get("/"))
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(
+        EMAIL_REGISTRATION_DELIVERY_BACKEND="email_registration.delivery.ThreadPoolDelivery",
+        EMAIL_REGISTRATION_DELIVERY_OPTIONS={"workers": 0, "maxsize": 2},
+    )
+    def test_queue_depth(self):
+        backend = get_delivery_backend()
+        self.assertIsInstance(backend, ThreadPoolDelivery)
+
+        response = self.client.post("/er/", {"email": "test@example.com"})
+        self.assertContains(response, "We sent you an email to test@example.com.")
+        self.assertEqual(backend.qsize(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+
+        backend.drain()
+        self.assertEqual(backend.qsize(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["test@example.com"])
+
+    def test_overflow(self):
+        backend = ThreadPoolDelivery(workers=0, maxsize=1, overflow="drop")
+        backend.deliver(_message("1@example.com"))
+        with self.assertLogs("email_registration.delivery", "WARNING"):
+            backend.deliver(_message("2@example.com"))
+        self.assertEqual((backend.qsize(), backend.dropped), (1, 1))
+        backend.close()
+        self.assertEqual([m.to for m in mail.outbox], [["1@example.com"]])
+
+        mail.outbox = []
+        backend = ThreadPoolDelivery(workers=0, maxsize=1, overflow="sync")
+        backend.deliver(_message("1@example.com"))
+        backend.deliver(_message("2@example.com"))
+        self.assertEqual(backend.qsize(), 1)
+        self.assertEqual([m.to for m in mail.outbox], [["2@example.com"]])
+        backend.close()
+        self.assertEqual(len(mail.outbox), 2)
+
+        mail.outbox = []
+        backend = ThreadPoolDelivery(workers=0, maxsize=1, timeout=0.01)
+        backend.deliver(_message("1@example.com"))
+        with self.assertRaises(QueueFull):
+            backend.deliver(_message("2@example.com"))
+        backend.close()
+        self.assertEqual(len(mail.outbox), 1)
+        with self.assertRaises(QueueFull):
+            backend.deliver(_message("3@example.com"))
+
+    def test_workers(self):
+        backend = ThreadPoolDelivery(workers=2)
+        for i in range(10):
+            backend.deliver(_message("%s@example.com" % i))
+        backend.close()
+        self.assertEqual(backend.qsize(), 0)
+        self.assertEqual(len(mail.outbox), 10)
+
+    @override_settings(
+        EMAIL_REGISTRATION_DELIVERY_BACKEND="email_registration.delivery.CallableDelivery",
+        EMAIL_REGISTRATION_DELIVERY_OPTIONS={
+            "callable": "testapp.test_delivery.enqueue"
+        },
+    )
+    def test_callable(self):
+        send_registration_mail("test@example.com", RequestFactory().get("/"))
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(len(enqueued), 1)
+        enqueued.pop().send()
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class BulkTest(TestCase):
+    def test_bulk(self):
+        user = User.objects.create_user("test", "existing@example.com")
+        emails = ("%s@example.com" % i for i in range(5))
+
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            autospec=True,
+            side_effect=locmem.EmailBackend.send_messages,
+        ) as send_messages:
+            results = send_registration_mails(
+                chain(emails, ["existing@example.com"]),
+                "http://testserver/",
+                users={user.email: user},
+                chunk_size=4,
+            )
+            self.assertEqual(len(mail.outbox), 0)
+            results = list(results)
+
+        self.assertEqual(
+            results,
+            [("%s@example.com" % i, None) for i in range(5)]
+            + [("existing@example.com", None)],
+        )
+        self.assertEqual(send_messages.call_count, 6)
+        self.assertEqual(
+            len({id(call.args[0]) for call in send_messages.call_args_list}), 1
+        )
+        self.assertEqual(len(mail.outbox), 6)
+
+        url = unquote(mail.outbox[5].body.splitlines()[2])
+        self.assertRegex(
+            url, r"^http://testserver/er/existing@example.com!%s!\w+:" % user.pk
+        )
+        response = self.client.get(url)
+        self.assertContains(response, 'id="id_new_password2"')
+
+    def test_bulk_failure(self):
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=OSError("Connection refused"),
+        ):
+            results = list(
+                send_registration_mails(
+                    ["1@example.com", "2@example.com"], "http://testserver"
+                )
+            )
+
+        self.assertEqual(
+            [email for email, error in results], ["1@example.com", "2@example.com"]
+        )
+        self.assertTrue(all(isinstance(error, OSError) for email, error in results))
+
+    def test_partial_failure(self):
+        # The relay refuses the second recipient of the chunk
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=[1, OSError("Recipient refused"), 1],
+        ):
+            results = list(
+                send_registration_mails(
+                    ["1@example.com", "2@example.com", "3@example.com"],
+                    "http://testserver",
+                )
+            )
+
+        self.assertEqual(results[0], ("1@example.com", None))
+        self.assertEqual(results[1][0], "2@example.com")
+        self.assertIsInstance(results[1][1], OSError)
+        self.assertEqual(results[2], ("3@example.com", None))
+
+
+class FlakyBackend(locmem.EmailBackend):
+    failures = 0
+    open_failures = 0
+
+    def open(self):
+        if FlakyBackend.open_failures:
+            FlakyBackend.open_failures -= 1
+            raise OSError("Connection refused")
+
+    def send_messages(self, messages):
+        if FlakyBackend.failures:
+            FlakyBackend.failures -= 1
+            raise OSError("Connection refused")
+        return super().send_messages(messages)
+
+
+class SpoolTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        FlakyBackend.failures = FlakyBackend.open_failures = 0
+
+    def _files(self):
+        return sorted(name.rpartition(".")[2] for name in os.listdir(self.directory))
+
+    def _wait_for(self, files):
+        for i in range(500):
+            if self._files() == files:
+                return
+            time.sleep(0.01)
+        self.fail("%r != %r" % (self._files(), files))
+
+    def test_spool(self):
+        with override_settings(
+            EMAIL_REGISTRATION_DELIVERY_BACKEND="email_registration.delivery.SpoolDelivery",
+            EMAIL_REGISTRATION_DELIVERY_OPTIONS={
+                "directory": self.directory,
+                "segment_age": 1,
+            },
+        ):
+            response = self.client.post("/er/", {"email": "test@example.com"})
+            self.assertContains(response, "We sent you an email to test@example.com.")
+            self.assertEqual(len(mail.outbox), 0)
+            self.assertEqual(self._files(), ["active"])
+
+            # Only sealed segments are drained
+            call_command("email_registration_drain_spool", verbosity=0)
+            self.assertEqual(len(mail.outbox), 0)
+
+            # The segment is sealed when it expires without further writes
+            self._wait_for(["spool"])
+            stdout = StringIO()
+            call_command("email_registration_drain_spool", stdout=stdout)
+
+        self.assertEqual(stdout.getvalue(), "Sent 1 spooled mails.\n")
+        self.assertEqual(self._files(), [])
+        self.assertEqual(mail.outbox[0].to, ["test@example.com"])
+        self.assertIn("Message-ID", mail.outbox[0].extra_headers)
+
+    def test_rotation(self):
+        backend = SpoolDelivery(self.directory, segment_size=1)
+        for i in range(3):
+            backend.deliver(_message("%s@example.com" % i))
+        self.assertEqual(self._files(), ["spool"] * 3)
+        backend.deliver(_message("3@example.com"))
+        backend.close()
+
+        with mock.patch("os.fsync", side_effect=os.fsync) as fsync:
+            backend = SpoolDelivery(self.directory, fsync_every=3, fsync_interval=60)
+            for i in range(7):
+                backend.deliver(_message())
+            self.assertEqual(fsync.call_count, 2)
+            backend.close()
+            self.assertEqual(fsync.call_count, 3)
+
+        self.assertEqual(drain_spool(self.directory), 11)
+        self.assertEqual(
+            [m.to for m in mail.outbox[:4]], [["%s@example.com" % i] for i in range(4)]
+        )
+        self.assertEqual(self._files(), [])
+
+    def test_expiry(self):
+        backend = SpoolDelivery(self.directory, segment_age=0.05)
+        backend.deliver(_message("1@example.com"))
+        self._wait_for(["spool"])
+        self.assertEqual(drain_spool(self.directory), 1)
+
+        # Segments sealed by size do not expire a second time
+        backend.segment_size = 1
+        backend.deliver(_message("2@example.com"))
+        time.sleep(0.1)
+        self.assertEqual(self._files(), ["spool"])
+        backend.close()
+        self.assertEqual(drain_spool(self.directory), 1)
+        self.assertEqual(
+            [m.to for m in mail.outbox], [["1@example.com"], ["2@example.com"]]
+        )
+
+    def test_background_drain(self):
+        backend = SpoolDelivery(self.directory, drain_interval=0.01)
+        backend.deliver(_message())
+        for i in range(200):
+            if mail.outbox:
+                break
+            time.sleep(0.01)
+        backend.close()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(self._files(), [])
+
+    def test_retry(self):
+        backend = SpoolDelivery(self.directory)
+        for i in range(5):
+            backend.deliver(_message("%s@example.com" % i))
+        # Spooled twice, e.g. by a retrying task
+        message = _message("5@example.com")
+        message.extra_headers["Message-ID"] = "<duplicate@example.com>"
+        backend.deliver(message)
+        backend.deliver(message)
+        backend.close()
+
+        connection = FlakyBackend()
+        sleep = mock.Mock()
+        FlakyBackend.failures = 3
+        with self.assertLogs("email_registration.delivery", "WARNING"):
+            sent = drain_spool(
+                self.directory,
+                batch_size=2,
+                connection=connection,
+                sleep=sleep,
+                max_backoff=3,
+            )
+        self.assertEqual(sent, 6)
+        self.assertEqual(
+            [call.args for call in sleep.call_args_list], [(1,), (2,), (3,)]
+        )
+        self.assertEqual(
+            [m.to for m in mail.outbox], [["%s@example.com" % i] for i in range(6)]
+        )
+
+    def test_relay_down(self):
+        backend = SpoolDelivery(self.directory)
+        backend.deliver(_message("1@example.com"))
+        backend.close()
+
+        sleep = mock.Mock()
+        FlakyBackend.open_failures = 10
+        with self.assertLogs("email_registration.delivery", "WARNING"):
+            with self.assertRaises(OSError):
+                drain_spool(self.directory, connection=FlakyBackend(), sleep=sleep)
+        self.assertEqual(
+            [call.args for call in sleep.call_args_list],
+            [(1,), (2,), (4,), (8,), (16,)],
+        )
+        self.assertEqual(self._files(), ["sent", "spool"])
+        self.assertEqual(len(mail.outbox), 0)
+
+        # The relay comes back
+        sleep = mock.Mock()
+        FlakyBackend.open_failures = 2
+        with self.assertLogs("email_registration.delivery", "WARNING"):
+            sent = drain_spool(self.directory, connection=FlakyBackend(), sleep=sleep)
+        self.assertEqual(sent, 1)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(self._files(), [])
+
+    def test_serialization(self):
+        backend = SpoolDelivery(self.directory)
+        message = _message("1@example.com")
+        message.bcc = ["2@example.com"]
+        backend.deliver(message)
+        backend.close()
+
+        [name] = os.listdir(self.directory)
+        with open(os.path.join(self.directory, name)) as f:
+            record = json.loads(f.read())
+        self.assertEqual(record["from"], message.from_email)
+        self.assertEqual(record["to"], ["1@example.com", "2@example.com"])
+
+        drain_spool(self.directory)
+        [sent] = mail.outbox
+        self.assertEqual(sent.recipients(), ["1@example.com", "2@example.com"])
+        self.assertEqual(sent.extra_headers["Message-ID"], record["id"])
+        data = sent.message().as_bytes(linesep="\r\n")
+        self.assertIn(b"\r\nTo: 1@example.com\r\n", data)
+        self.assertNotIn(b"Bcc", data)
+        self.assertIn(b"http://x/", data)
+
+    def test_failure(self):
+        backend = SpoolDelivery(self.directory)
+        for i in range(4):
+            backend.deliver(_message("%s@example.com" % i))
+        backend.close()
+
+        # The relay goes down after sending two mails
+        with mock.patch.object(
+            locmem.EmailBackend,
+            "send_messages",
+            autospec=True,
+            side_effect=[1, 1] + [OSError("Connection refused")] * 3,
+        ):
+            with self.assertLogs("email_registration.delivery", "WARNING"):
+                with self.assertRaises(OSError):
+                    drain_spool(self.directory, retries=2, sleep=mock.Mock())
+        self.assertEqual(self._files(), ["sent", "spool"])
+
+        self.assertEqual(drain_spool(self.directory), 2)
+        self.assertEqual(
+            [m.to for m in mail.outbox], [["2@example.com"], ["3@example.com"]]
+        )
+        self.assertEqual(self._files(), [])
+
+    def test_crashed_process(self):
+        process = subprocess.Popen(["true"])
+        process.wait()
+        owner = "%s-%s" % (socket.gethostname().replace(".", "_"), process.pid)
+
+        backend = SpoolDelivery(self.directory)
+        backend.deliver(_message("1@example.com"))
+        backend.deliver(_message("2@example.com"))
+        backend.close()
+        [name] = os.listdir(self.directory)
+        with open(os.path.join(self.directory, name), "rb") as f:
+            data = f.read()
+        os.remove(os.path.join(self.directory, name))
+
+        # The process crashed while writing the second message
+        with open(os.path.join(self.directory, "%s-1-1.active" % owner), "wb") as f:
+            f.write(data[:-20])
+        # A process which is still running
+        with open(
+            os.path.join(
+                self.directory, "%s-%s-1-1.active" % (socket.gethostname(), os.getpid())
+            ),
+            "wb",
+        ) as f:
+            f.write(data)
+
+        with self.assertLogs("email_registration.delivery", "WARNING"):
+            self.assertEqual(drain_spool(self.directory), 1)
+        self.assertEqual(self._files(), ["active"])
+        self.assertEqual(mail.outbox[0].to, ["1@example.com"])
@@ -0,0 +1,171 @@
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+from unittest import mock
+from urllib.parse import unquote
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+
+from email_registration.management.commands import email_registration_invite
+from email_registration.utils import get_base_url
+
+
+class InviteTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _path(self, name, content=None):
+        path = os.path.join(self.directory, name)
+        if content is not None:
+            with open(path, "w") as f:
+                f.write(content)
+        return path
+
+    def test_base_url(self):
+        self.assertEqual(get_base_url(), "https://example.com")
+        with override_settings(EMAIL_REGISTRATION_BASE_URL="http://testserver"):
+            self.assertEqual(get_base_url(), "http://testserver")
+
+    @override_settings(
+        EMAIL_REGISTRATION_NORMALIZE_EMAIL="email_registration.normalization.lowercase"
+    )
+    def test_csv(self):
+        user = User.objects.create_user("test", "existing@example.com")
+        path = self._path(
+            "invite.csv",
+            "name,Email\nA,a@example.com\nB,not an address\nC,Existing@example.com\n",
+        )
+        failures = self._path("failures.csv")
+        stderr = StringIO()
+
+        Site.objects.clear_cache()
+        # The current site and the existing users
+        with self.assertNumQueries(2):
+            call_command(
+                "email_registration_invite",
+                path,
+                failures=failures,
+                stderr=stderr,
+            )
+
+        self.assertRegex(stderr.getvalue(), r"^2 sent, 1 failed in [\d.]+s")
+        with open(failures) as f:
+            self.assertEqual(f.read(), "not an address,Invalid email address\n")
+        self.assertEqual(
+            [m.to for m in mail.outbox], [["a@example.com"], ["Existing@example.com"]]
+        )
+        self.assertIn(
+            "https://example.com/er/a@example.com:", unquote(mail.outbox[0].body)
+        )
+        self.assertIn(
+            "https://example.com/er/existing@example.com!%s!" % user.pk,
+            unquote(mail.outbox[1].body),
+        )
+
+    def test_mixed_case_user(self):
+        user = User.objects.create_user("test", "Existing@example.com")
+        call_command(
+            "email_registration_invite",
+            self._path("invite.csv", "Existing@example.com\n"),
+            base_url="http://testserver",
+            verbosity=0,
+        )
+        self.assertIn(
+            "/er/Existing@example.com!%s!" % user.pk, unquote(mail.outbox[0].body)
+        )
+
+    def test_checkpoint(self):
+        path = self._path(
+            "invite.jsonl",
+            "".join(
+                json.dumps({"email": "%s@example.com" % i}) + "\n" for i in range(5)
+            ),
+        )
+        checkpoint = self._path("checkpoint.json")
+
+        calls = []
+        original = email_registration_invite._send_chunk
+
+        def interrupt(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return original(*args)
+
+        with mock.patch.object(email_registration_invite, "_send_chunk", interrupt):
+            with self.assertRaisesRegex(CommandError, "after 2 addresses"):
+                call_command(
+                    "email_registration_invite",
+                    path,
+                    base_url="http://testserver",
+                    chunk_size=2,
+                    checkpoint=checkpoint,
+                    verbosity=0,
+                )
+        self.assertEqual(len(mail.outbox), 2)
+
+        call_command(
+            "email_registration_invite",
+            path,
+            base_url="http://testserver",
+            chunk_size=2,
+            checkpoint=checkpoint,
+            verbosity=0,
+        )
+        self.assertEqual(
+            [m.to for m in mail.outbox], [["%s@example.com" % i] for i in range(5)]
+        )
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f), {"offset": 5})
+
+    def test_processes(self):
+        path = self._path(
+            "invite.csv", "".join("%s@example.com\n" % i for i in range(25))
+        )
+        outbox = self._path("outbox")
+        stderr = StringIO()
+
+        audit = self._path("audit.jsonl")
+
+        with override_settings(
+            EMAIL_BACKEND="django.core.mail.backends.filebased.EmailBackend",
+            EMAIL_FILE_PATH=outbox,
+            EMAIL_REGISTRATION_AUDIT_SINK="email_registration.audit.FileAuditSink",
+            EMAIL_REGISTRATION_AUDIT_OPTIONS={"path": audit, "flush_interval": 3600},
+        ):
+            call_command(
+                "email_registration_invite",
+                path,
+                base_url="http://testserver",
+                processes=2,
+                chunk_size=4,
+                stderr=stderr,
+                verbosity=2,
+            )
+
+        self.assertIn("25 sent, 0 failed", stderr.getvalue().splitlines()[-1])
+        recipients = []
+        for name in os.listdir(outbox):
+            with open(os.path.join(outbox, name)) as f:
+                recipients.extend(
+                    line[4:]
+                    for line in f.read().splitlines()
+                    if line.startswith("To: ")
+                )
+        self.assertEqual(
+            sorted(recipients), sorted("%s@example.com" % i for i in range(25))
+        )
+        # One connection per worker process
+        self.assertLessEqual(len(os.listdir(outbox)), 2)
+
+        with open(audit) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 25)
+        self.assertEqual({record["status"] for record in records}, {"sent"})
@@ -0,0 +1,65 @@
+from urllib.parse import unquote
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.test import TestCase, override_settings
+
+from email_registration import metrics
+from email_registration.utils import InvalidCode, decode, get_signer
+
+
+memory_sink = override_settings(
+    EMAIL_REGISTRATION_METRICS_SINK="email_registration.metrics.MemorySink"
+)
+
+
+class MetricsTest(TestCase):
+    @memory_sink
+    def test_registration(self):
+        sink = metrics.get_sink()
+        self.client.post("/er/", {"email": "test@example.com"})
+
+        self.assertEqual(
+            [name for name, seconds, tags in sink.spans],
+            [
+                "exists_query",
+                "form_validation",
+                "sign",
+                "reverse",
+                "render",
+                "send",
+            ],
+        )
+        self.assertTrue(all(seconds >= 0 for name, seconds, tags in sink.spans))
+        self.assertEqual(sink.count("mails_sent"), 1)
+
+        url = unquote(mail.outbox[0].body.splitlines()[2])
+        self.client.get(url)
+        self.assertEqual(sink.count("codes_decoded"), 1)
+
+    @memory_sink
+    def test_decode_failures(self):
+        sink = metrics.get_sink()
+        user = User.objects.create_user("test", "test@example.com")
+
+        codes = {
+            "bad_signature": "test@example.com:abc:def",
+            "malformed": get_signer().sign("test@example.com:1"),
+            "unknown_user": get_signer().sign("test@example.com!zz!0"),
+            "used": get_signer().sign("test@example.com!%s!1" % user.pk),
+        }
+        for reason, code in codes.items():
+            with self.assertRaises(InvalidCode) as cm:
+                decode(code)
+            self.assertEqual(cm.exception.reason, reason)
+            self.assertEqual(sink.count("decode_failures", reason=reason), 1)
+
+        with self.assertRaises(InvalidCode) as cm:
+            decode(get_signer().sign("test@example.com"), max_age=-1)
+        self.assertEqual(cm.exception.reason, "expired")
+        self.assertEqual(sink.count("decode_failures", reason="expired"), 1)
+
+    def test_no_sink(self):
+        self.assertIsNone(metrics.get_sink())
+        self.assertIs(metrics.timed("render"), metrics.timed("send"))
+        metrics.incr("mails_sent")
@@ -0,0 +1,120 @@
+from io import StringIO
+from urllib.parse import unquote
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from email_registration.normalization import canonical, lowercase
+from email_registration.utils import decode, get_confirmation_url, get_signer
+
+
+LOWERCASE = "email_registration.normalization.lowercase"
+
+
+class NormalizationTest(TestCase):
+    def test_functions(self):
+        self.assertEqual(lowercase(" Foo@Example.COM "), "foo@example.com")
+        self.assertEqual(canonical("Foo.Bar+x@Example.com"), "foo.bar+x@example.com")
+        self.assertEqual(canonical("John.Doe+news@googlemail.com"), "johndoe@gmail.com")
+        self.assertEqual(canonical("john.doe+news@outlook.com"), "john.doe@outlook.com")
+
+    def test_mixed_case_default(self):
+        # Addresses are kept as entered unless normalization is enabled
+        User.objects.create_user("foo", "Foo@example.com")
+        response = self.client.post("/er/", {"email": "Foo@example.com"})
+        self.assertContains(response, "Did you want to reset your password?")
+        self.assertEqual(len(mail.outbox), 0)
+
+        url = get_confirmation_url("Foo@example.com", "http://testserver")
+        response = self.client.post(
+            url, {"new_password1": "pass", "new_password2": "pass"}
+        )
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
+        self.assertEqual(User.objects.count(), 1)
+
+    @override_settings(EMAIL_REGISTRATION_NORMALIZE_EMAIL=LOWERCASE)
+    def test_registration(self):
+        User.objects.create(username="foo", email="foo@example.com")
+        with self.assertNumQueries(1) as queries:
+            response = self.client.post("/er/", {"email": "Foo@Example.com"})
+        self.assertContains(response, "Did you want to reset your password?")
+        self.assertIn(
+            "\"email\" = 'foo@example.com'", queries.captured_queries[0]["sql"]
+        )
+
+        response = self.client.post("/er/", {"email": "Bar@Example.com"})
+        self.assertContains(response, "We sent you an email to bar@example.com.")
+        url = unquote(
+            [line for line in mail.outbox[0].body.splitlines() if "testserver" in line][
+                0
+            ]
+        )
+        self.assertIn("/er/bar@example.com:", url)
+
+        self.client.post(url, {"new_password1": "pass", "new_password2": "pass"})
+        self.assertEqual(
+            User.objects.get(username="bar@example.com").email, "bar@example.com"
+        )
+
+    @override_settings(EMAIL_REGISTRATION_NORMALIZE_EMAIL=LOWERCASE)
+    def test_payload(self):
+        url = get_confirmation_url("Foo@Example.com", "http://testserver")
+        self.assertIn("/er/foo@example.com:", url)
+
+        # Links signed by earlier releases may contain uppercase letters
+        code = get_signer().sign("Foo@Example.com")
+        self.assertEqual(decode(code), ("Foo@Example.com", None))
+        User.objects.create(username="foo", email="foo@example.com")
+        response = self.client.get("/er/%s/" % code, follow=True)
+        self.assertContains(response, "already exists as an account")
+
+    @override_settings(
+        EMAIL_REGISTRATION_NORMALIZE_EMAIL="email_registration.normalization.canonical"
+    )
+    def test_canonical(self):
+        User.objects.create(username="foo", email="foobar@gmail.com")
+        response = self.client.post("/er/", {"email": "Foo.Bar+spam@googlemail.com"})
+        self.assertContains(response, "Did you want to reset your password?")
+
+
+class DuplicatesCommandTest(TestCase):
+    def test_command(self):
+        for i, email in enumerate(
+            [
+                "a@example.com",
+                "A@example.com",
+                "b@example.com",
+                "a.b@gmail.com",
+                "ab@gmail.com",
+                "",
+            ]
+        ):
+            User.objects.create(username="user%s" % i, email=email)
+
+        stdout, stderr = StringIO(), StringIO()
+        call_command("email_registration_duplicates", stdout=stdout, stderr=stderr)
+        self.assertEqual(stdout.getvalue(), "")
+
+        call_command(
+            "email_registration_duplicates",
+            normalize=LOWERCASE,
+            stdout=stdout,
+            stderr=stderr,
+        )
+        self.assertEqual(
+            sorted(line.split("\t")[2] for line in stdout.getvalue().splitlines()),
+            ["A@example.com", "a@example.com"],
+        )
+        self.assertIn("2 rows", stderr.getvalue())
+
+        stdout = StringIO()
+        call_command(
+            "email_registration_duplicates",
+            normalize="email_registration.normalization.canonical",
+            chunk_size=2,
+            stdout=stdout,
+            stderr=stderr,
+        )
+        self.assertEqual(len(stdout.getvalue().splitlines()), 4)
@@ -0,0 +1,130 @@
+import re
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+from django.utils.asyncio import async_unsafe
+
+from email_registration.opaque import CacheCodeStore
+from email_registration.utils import (
+    InvalidCode,
+    adecode,
+    decode,
+    get_cache,
+    get_confirmation_url,
+    send_registration_mails,
+)
+
+
+def _code(url):
+    return url.split("/")[-2]
+
+
+@override_settings(
+    EMAIL_REGISTRATION_CODE_STORE="email_registration.opaque.CacheCodeStore"
+)
+class OpaqueCodeTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    @override_settings(EMAIL_REGISTRATION_CODE_STORE=None)
+    def test_no_store(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_confirmation_url("test@example.com", "", opaque=True)
+
+    def test_registration(self):
+        url = get_confirmation_url("test@example.com", "", opaque=True)
+        self.assertRegex(url, r"^/er/[\w-]{16}/$")
+        self.assertEqual(decode(_code(url)), ("test@example.com", None))
+
+        response = self.client.get(url)
+        self.assertContains(response, 'id="id_new_password2"')
+        response = self.client.post(
+            url, {"new_password1": "pass", "new_password2": "pass"}
+        )
+        self.assertRedirects(response, "/ac/login/", fetch_redirect_response=False)
+        self.assertEqual(User.objects.get().email, "test@example.com")
+
+    def test_existing_user(self):
+        user = User.objects.create_user("test", "test@example.com")
+        with override_settings(EMAIL_REGISTRATION_OPAQUE_CODES=True):
+            url = get_confirmation_url(user.email, "", user=user)
+        self.assertNotIn("example.com", url)
+        self.assertEqual(decode(_code(url)), (user.email, user))
+
+        user.last_login = user.date_joined
+        user.save()
+        with self.assertRaises(InvalidCode) as cm:
+            decode(_code(url))
+        self.assertEqual(cm.exception.reason, "used")
+
+    def test_invalid(self):
+        with self.assertRaises(InvalidCode) as cm:
+            decode("A" * 16)
+        self.assertEqual(cm.exception.reason, "expired")
+
+        opaque = _code(get_confirmation_url("test@example.com", "", opaque=True))
+        signed = _code(get_confirmation_url("test@example.com", ""))
+        self.assertEqual(decode(signed)[0], "test@example.com")
+        with self.assertRaises(InvalidCode) as cm:
+            decode(opaque, opaque=False)
+        self.assertEqual(cm.exception.reason, "malformed")
+        with self.assertRaises(InvalidCode) as cm:
+            decode(signed, opaque=True)
+        self.assertEqual(cm.exception.reason, "malformed")
+
+    def test_timeout(self):
+        with mock.patch.object(CacheCodeStore, "set_many") as set_many:
+            url = get_confirmation_url(
+                "test@example.com", "", opaque=True, max_age=3600
+            )
+        (mapping, timeout), _ = set_many.call_args
+        self.assertEqual(list(mapping), [_code(url)])
+        self.assertEqual(timeout, 3600)
+
+    def test_bulk(self):
+        emails = ["test-%s@example.com" % i for i in range(5)]
+        with mock.patch.object(
+            CacheCodeStore,
+            "set_many",
+            autospec=True,
+            side_effect=CacheCodeStore.set_many,
+        ) as set_many:
+            results = list(
+                send_registration_mails(emails, "", chunk_size=2, opaque=True)
+            )
+        self.assertEqual(results, [(email, None) for email in emails])
+        self.assertEqual(set_many.call_count, 3)
+
+        for message in mail.outbox:
+            (url,) = [line for line in message.body.splitlines() if "/er/" in line]
+            self.assertEqual(decode(_code(url.strip()))[0], message.to[0])
+
+    @override_settings(EMAIL_REGISTRATION_FAST_REJECT=True)
+    def test_fast_reject(self):
+        url = get_confirmation_url("test@example.com", "", opaque=True)
+        self.assertContains(self.client.get(url), 'id="id_new_password2"')
+
+    async def test_async(self):
+        url = get_confirmation_url("test@example.com", "", opaque=True)
+        self.assertEqual(await adecode(_code(url)), ("test@example.com", None))
+        with self.assertRaises(InvalidCode):
+            await adecode("A" * 16)
+
+    @override_settings(EMAIL_REGISTRATION_OPAQUE_CODES=True)
+    async def test_async_registration(self):
+        # Stores using the database must not be called in the event loop
+        with mock.patch.object(
+            CacheCodeStore,
+            "set_many",
+            autospec=True,
+            side_effect=async_unsafe(CacheCodeStore.set_many),
+        ):
+            response = await self.async_client.post(
+                "/er-async/", {"email": "test@example.com"}
+            )
+        self.assertContains(response, "We sent you an email")
+        (url,) = re.findall(r"/er/[\w-]{16}/", mail.outbox[0].body)
+        self.assertEqual(await adecode(_code(url)), ("test@example.com", None))
@@ -0,0 +1,133 @@
+import re
+
+from django.contrib.auth.forms import SetPasswordForm
+from django.contrib.auth.models import User
+from django.test import Client, RequestFactory, TestCase, override_settings
+
+from email_registration import pages
+from email_registration.utils import get_cache, get_confirmation_url
+
+
+def _csrf_token(response):
+    return re.search(
+        r'name="csrfmiddlewaretoken" value="([^"]+)"', response.content.decode()
+    ).group(1)
+
+
+@override_settings(EMAIL_REGISTRATION_CACHE_PAGES=True)
+class PageCacheTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        pages._pages.clear()
+        self.client = Client(enforce_csrf_checks=True)
+
+    def test_password_form(self):
+        url = get_confirmation_url("test@example.com", "")
+        with self.assertTemplateUsed("registration/password_set_form.html"):
+            first = self.client.get(url)
+        with self.assertTemplateNotUsed("registration/password_set_form.html"):
+            second = self.client.get(url)
+
+        self.assertContains(second, 'id="id_new_password2"')
+        self.assertContains(second, "Please set a password.")
+        token = _csrf_token(second)
+        self.assertNotEqual(_csrf_token(first), token)
+        self.assertEqual(
+            first.content.decode().replace(_csrf_token(first), token),
+            second.content.decode(),
+        )
+
+        # Errors are part of the key
+        response = self.client.post(
+            url,
+            {
+                "new_password1": "pass",
+                "new_password2": "other",
+                "csrfmiddlewaretoken": token,
+            },
+        )
+        self.assertContains(response, "fields didn")
+        self.assertNotContains(self.client.get(url), "fields didn")
+
+        # The substituted token is valid
+        response = self.client.post(
+            url,
+            {
+                "new_password1": "pass",
+                "new_password2": "pass",
+                "csrfmiddlewaretoken": token,
+            },
+        )
+        self.assertRedirects(response, "/ac/login/", fetch_redirect_response=False)
+
+    def test_sent(self):
+        self.client.get(get_confirmation_url("test@example.com", ""))
+        token = self.client.cookies["csrftoken"].value
+
+        self.client.post(
+            "/er/", {"email": "first@example.com", "csrfmiddlewaretoken": token}
+        )
+        with self.assertTemplateNotUsed("registration/email_registration_sent.html"):
+            response = self.client.post(
+                "/er/", {"email": "a&b@example.com", "csrfmiddlewaretoken": token}
+            )
+        self.assertContains(response, "We sent you an email to a&amp;b@example.com.")
+        self.assertNotContains(response, "first@example.com")
+
+    def test_authenticated(self):
+        User.objects.create_user("admin", "admin@example.com", "pass")
+        self.client.login(username="admin", password="pass")
+        url = get_confirmation_url("test@example.com", "")
+        self.client.get(url)
+        with self.assertTemplateUsed("registration/password_set_form.html"):
+            self.client.get(url)
+        self.assertEqual(pages._pages, {})
+
+    async def test_async_authenticated(self):
+        await User.objects.acreate_user("admin", "admin@example.com", "pass")
+        await self.async_client.alogin(username="admin", password="pass")
+        url = get_confirmation_url("test@example.com", "").replace("/er/", "/er-async/")
+        response = await self.async_client.get(url)
+        self.assertContains(response, 'id="id_new_password2"')
+        self.assertEqual(pages._pages, {})
+
+        await self.async_client.alogout()
+        response = await self.async_client.get(url)
+        self.assertContains(response, 'id="id_new_password2"')
+        self.assertEqual(len(pages._pages), 1)
+
+    def _templates(self, **templates):
+        return self.settings(
+            TEMPLATES=[
+                {
+                    "BACKEND": "django.template.backends.django.DjangoTemplates",
+                    "DIRS": [],
+                    "OPTIONS": {
+                        "loaders": [
+                            ("django.template.loaders.locmem.Loader", templates)
+                        ]
+                    },
+                }
+            ]
+        )
+
+    def test_form_user(self):
+        with self._templates(**{"page.html": "{{ form.user.get_username }}"}):
+            for username in ["first", "second", "first"]:
+                form = SetPasswordForm(User(username=username))
+                response = pages.render_page(
+                    RequestFactory().get("/"),
+                    "page.html",
+                    {"form": form},
+                    key=pages.form_state(form),
+                )
+                self.assertEqual(response.content.decode(), username)
+            self.assertEqual(len(pages._pages), 2)
+
+    def test_not_substitutable(self):
+        with self._templates(**{"page.html": "{{ email|upper }} {% now 'u' %}"}):
+            response = pages.render_page(
+                RequestFactory().get("/"), "page.html", {"email": "test@example.com"}
+            )
+            self.assertContains(response, "TEST@EXAMPLE.COM")
+            self.assertEqual(list(pages._pages.values()), [None])
@@ -1,20 +1,43 @@
+import os
 import re
+import subprocess
+import sys
 import time
+from unittest import mock
 from urllib.parse import unquote
 
 from django.contrib.auth.models import User
-from django.core import mail
-from django.test import TestCase
+from django.contrib.sites.models import Site
+from django.contrib.sites.requests import RequestSite
+from django.core import mail, signing
+from django.db import connection
+from django.template.loader import get_template
+from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
-from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone, translation
+from django.utils.http import int_to_base36
 
 
 try:
-    from django.urls import reverse
+    from django.urls import NoReverseMatch, reverse, set_script_prefix
 except ImportError:  # pragma: no cover
-    from django.core.urlresolvers import reverse
-
-from email_registration.utils import get_signer, send_registration_mail
+    from django.core.urlresolvers import NoReverseMatch, reverse, set_script_prefix
+
+from email_registration import codec, metrics, utils
+from email_registration.utils import (
+    InvalidCode,
+    decode,
+    get_cache,
+    get_confirmation_path,
+    get_confirmation_url,
+    get_prerendered_mail,
+    get_signer,
+    get_user_model_info,
+    render_to_mail,
+    send_registration_mail,
+    split_subject,
+)
 
 
 def _messages(response):
@@ -40,7 +63,7 @@ class RegistrationTest(TestCase):
         body = mail.outbox[0].body
         url = unquote([line for line in body.splitlines() if "testserver" in line][0])
 
-        self.assertTrue("http://testserver/er/test@example.com:::" in url)
+        self.assertRegex(url, r"^http://testserver/er/test@example.com:\w+:[\w-]+/$")
 
         response = self.client.get(url)
         self.assertContains(response, 'id="id_new_password2"')
@@ -90,7 +113,7 @@ class RegistrationTest(TestCase):
         url = unquote([line for line in body.splitlines() if "testserver" in line][0])
 
         self.assertTrue(
-            re.match(r"http://testserver/er/test@example.com:\d+:\w+:", url)
+            re.match(r"http://testserver/er/test@example.com!\w+!\w+:", url)
         )
 
         response = self.client.get(url)
@@ -129,7 +152,7 @@ class RegistrationTest(TestCase):
         )
 
         response = self.client.get(
-            url.replace("com:", "ch:", 1),
+            url.replace("com!", "ch!", 1),
             follow=True,
         )
         self.assertEqual(
@@ -178,7 +201,7 @@ class RegistrationTest(TestCase):
         body = mail.outbox[0].body
         url = unquote([line for line in body.splitlines() if "testserver" in line][0])
 
-        self.assertTrue("http://testserver/er/test@example.com:::" in url)
+        self.assertRegex(url, r"^http://testserver/er/test@example.com:\w+:[\w-]+/$")
 
         User.objects.create_user("test", "test@example.com", "blaa")
 
@@ -215,3 +238,342 @@ class RegistrationTest(TestCase):
                 " registration request. Please try again."
             ],
         )
+
+
+class RenderToMailTest(TestCase):
+    def test_split_subject(self):
+        self.assertEqual(split_subject("\n\nSubject\n\nBody\n\n"), ("Subject", "Body"))
+        self.assertEqual(
+            split_subject("Subject\r\n\r\nLine 1\r\nLine 2\r\n"),
+            ("Subject", "Line 1\nLine 2"),
+        )
+        self.assertEqual(split_subject("Subject"), ("Subject", ""))
+        self.assertEqual(split_subject(""), ("", ""))
+
+    @override_settings(EMAIL_REGISTRATION_CACHE_TEMPLATES=True)
+    def test_template_cache(self):
+        with mock.patch(
+            "email_registration.utils.get_template", side_effect=get_template
+        ) as patched:
+            for i in range(3):
+                message = render_to_mail(
+                    "registration/email_registration_email",
+                    {"url": "http://example.com/%s/" % i},
+                    to=["test@example.com"],
+                )
+            self.assertEqual(patched.call_count, 2)  # .txt and missing .html
+
+            with override_settings(EMAIL_REGISTRATION_CACHE_TEMPLATES=False):
+                render_to_mail("registration/email_registration_email", {"url": ""})
+                render_to_mail("registration/email_registration_email", {"url": ""})
+            self.assertEqual(patched.call_count, 6)
+
+        self.assertEqual(message.subject, "Registration link")
+        self.assertIn("http://example.com/2/", message.body)
+        self.assertEqual(message.alternatives, [])
+
+    @override_settings(
+        EMAIL_REGISTRATION_CACHE_TEMPLATES=True,
+        EMAIL_REGISTRATION_PRERENDER_MAIL=True,
+    )
+    def test_prerender(self):
+        context = {"url": "http://example.com/?a=1&b=<2>", "email": "a&b@example.com"}
+
+        for language in ["en", "de"]:
+            with self.subTest(language=language), translation.override(language):
+                with override_settings(EMAIL_REGISTRATION_PRERENDER_MAIL=False):
+                    expected = render_to_mail("prerender/mail", context)
+                with mock.patch(
+                    "email_registration.utils._prerender",
+                    side_effect=utils._prerender,
+                ) as patched:
+                    message = render_to_mail("prerender/mail", context)
+                    message = render_to_mail("prerender/mail", context)
+
+                # The text and the HTML version, once per language
+                self.assertEqual(patched.call_count, 2)
+                self.assertEqual(message.subject, expected.subject)
+                self.assertEqual(message.body, expected.body)
+                self.assertEqual(message.alternatives, expected.alternatives)
+
+        self.assertEqual(message.subject, "Registrierungslink")
+        self.assertIn(
+            "<http://example.com/?a=1&amp;b=&lt;2&gt;> a&amp;b@example.com",
+            message.body,
+        )
+        self.assertIn("\nhttp://example.com/?a=1&b=<2>", message.body)
+        self.assertIn(
+            'href="http://example.com/?a=1&amp;b=&lt;2&gt;"', message.alternatives[0][0]
+        )
+
+        prerendered = get_prerendered_mail("prerender/mail", context)
+        self.assertIs(prerendered, get_prerendered_mail("prerender/mail", context))
+        self.assertEqual(prerendered[0][1], ("url", True))
+
+    @override_settings(EMAIL_REGISTRATION_PRERENDER_MAIL=True)
+    def test_prerender_fallback(self):
+        self.assertIsNone(get_prerendered_mail("prerender/filtered", {"url": "x"}))
+        self.assertIsNone(get_prerendered_mail("prerender/mail", {"url": 42}))
+        message = render_to_mail("prerender/filtered", {"url": "http://x/"})
+        self.assertEqual(message.body, "HTTP://X/")
+
+
+@override_settings(
+    EMAIL_REGISTRATION_DECODE_CACHE_TIMEOUT=60,
+    EMAIL_REGISTRATION_RESTRICT_USER_FIELDS=True,
+)
+class DecodeCacheTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    def test_decode_cache(self):
+        user = User.objects.create_user("test", "test@example.com", "old")
+        url = get_confirmation_url(user.email, "http://testserver", user=user)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, 'id="id_new_password2"')
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"last_login"', queries[0]["sql"])
+        self.assertNotIn('"password"', queries[0]["sql"])
+
+        with self.assertNumQueries(1):  # The UPDATE
+            response = self.client.post(
+                url, {"new_password1": "pass", "new_password2": "pass"}
+            )
+        self.assertRedirects(response, "/ac/login/")
+        user.refresh_from_db()
+        self.assertTrue(user.check_password("pass"))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(decode(unquote(url).split("/")[-2]), (user.email, user))
+
+
+@override_settings(
+    EMAIL_REGISTRATION_FAST_REJECT=True,
+    EMAIL_REGISTRATION_METRICS_SINK="email_registration.metrics.MemorySink",
+)
+class FastRejectTest(TestCase):
+    def setUp(self):
+        metrics.get_sink().counters.clear()
+
+    def assertRejected(self, code, reason, count=1):
+        with self.assertNumQueries(0):
+            response = self.client.get("/er/%s/" % code)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response["Cache-Control"], "public, max-age=86400")
+        self.assertNotIn("Vary", response)
+        self.assertFalse(response.cookies)
+        self.assertEqual(
+            metrics.get_sink().count("fast_rejects", reason=reason), count, code
+        )
+
+    def test_rejected(self):
+        code = get_confirmation_url("test@example.com", "").split("/")[-2]
+        self.assertRejected(code[:-1], "bad_signature")
+        self.assertRejected("x" * 513, "malformed")
+        self.assertRejected("wp-login.php", "malformed", count=2)
+        self.assertRejected("a:b:c%00d", "malformed", count=3)
+
+    def test_expired_and_valid(self):
+        url = get_confirmation_url("test@example.com", "")
+        with mock.patch("time.time", return_value=time.time() + 4 * 86400):
+            response = self.client.get(url)
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
+
+        response = self.client.get(url)
+        self.assertContains(response, 'id="id_new_password2"')
+        self.assertEqual(metrics.get_sink().count("fast_rejects", reason="expired"), 0)
+
+    @override_settings(EMAIL_REGISTRATION_FAST_REJECT=False)
+    def test_disabled(self):
+        response = self.client.get("/er/wp-login.php/")
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
+        self.assertIn("messages", response.cookies)
+
+
+class CodecTest(TestCase):
+    def test_roundtrip(self):
+        user = User.objects.create_user("test", "test@example.com")
+        self.assertEqual(codec.dumps("test@example.com"), "test@example.com")
+        self.assertEqual(
+            codec.loads("test@example.com"), ("test@example.com", None, None, False)
+        )
+        self.assertEqual(
+            codec.loads(codec.dumps("a!b@example.com", user)),
+            ("a!b@example.com", user.pk, 0, False),
+        )
+
+        user.last_login = timezone.now()
+        self.assertEqual(
+            codec.loads(codec.dumps("test@example.com", user))[2],
+            int(user.last_login.timestamp()),
+        )
+
+        for payload in ["test@example.com:1", "test@example.com!1", "a!b!c", ""]:
+            with self.assertRaises(ValueError):
+                codec.loads(payload)
+
+    def test_legacy_codes(self):
+        user = User.objects.create_user("test", "test@example.com")
+        user.last_login = timezone.now()
+        user.save()
+
+        code = get_signer().sign(
+            "test@example.com:%s:%s"
+            % (user.pk, int_to_base36(int(user.last_login.strftime("%s"))))
+        )
+        self.assertEqual(decode(code), ("test@example.com", user))
+
+        code = get_signer().sign("test@example.com::")
+        self.assertEqual(decode(code), ("test@example.com", None))
+
+
+class SignerTest(TestCase):
+    def test_compatible(self):
+        signer = get_signer()
+        self.assertIs(signer, get_signer())
+        self.assertEqual(
+            signer.signature("test@example.com"),
+            signing.TimestampSigner(salt="email_registration").signature(
+                "test@example.com"
+            ),
+        )
+        self.assertEqual(
+            get_signer(algorithm="blake2b").signature("test"),
+            signing.TimestampSigner(
+                salt="email_registration", algorithm="blake2b"
+            ).signature("test"),
+        )
+
+    def test_key_rotation(self):
+        code = get_signer().sign("test@example.com")
+
+        with override_settings(SECRET_KEY="new", SECRET_KEY_FALLBACKS=["supersikret"]):
+            self.assertEqual(decode(code), ("test@example.com", None))
+        with override_settings(SECRET_KEY="new"):
+            with self.assertRaises(InvalidCode):
+                decode(code)
+
+    def test_algorithm_rotation(self):
+        code = get_signer().sign("test@example.com")
+
+        with override_settings(EMAIL_REGISTRATION_SIGNING_ALGORITHM="blake2b"):
+            new_code = get_signer().sign("test@example.com")
+            with self.assertRaises(InvalidCode):
+                decode(code)
+
+            with override_settings(
+                EMAIL_REGISTRATION_SIGNING_FALLBACK_ALGORITHMS=["sha256"]
+            ):
+                self.assertEqual(decode(code), ("test@example.com", None))
+                self.assertEqual(decode(new_code), ("test@example.com", None))
+
+
+class UserModelTest(TestCase):
+    def test_import_before_setup(self):
+        # URLconfs may be imported before the app registry is ready, e.g. in
+        # prefork worker setups.
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import email_registration.urls, email_registration.views",
+            ],
+            env={
+                **os.environ,
+                "DJANGO_SETTINGS_MODULE": "testapp.settings",
+                "PYTHONPATH": os.pathsep.join(sys.path),
+            },
+            check=True,
+        )
+
+    def test_user_model_info(self):
+        info = get_user_model_info()
+        self.assertIs(info, get_user_model_info())
+        self.assertIs(info.model, User)
+        self.assertEqual(info.username_field.name, "username")
+        self.assertEqual(info.email_field, "email")
+        self.assertEqual(info.restricted_fields, ("last_login", "username", "email"))
+
+        from email_registration import views
+
+        self.assertIs(views.User, User)
+        self.assertEqual(views.USERNAME_FIELD, "username")
+
+        user = views._new_user("a" * 150 + "@example.com")
+        self.assertEqual(len(user.username), 25)
+        self.assertEqual(user.email, "a" * 150 + "@example.com")
+
+
+class ConfirmationURLTest(TestCase):
+    def test_path(self):
+        codes = [
+            "test@example.com:1u0b2C:abc-_",
+            "a b%c?d#e+f~g!h&i=j'k@example.com:x:y",
+            "jürg@example.com:x:y",
+            "test@example.com!~uuid!0:x:y",
+        ]
+        for code in codes:
+            with self.subTest(code=code):
+                self.assertEqual(
+                    get_confirmation_path(code),
+                    reverse("email_registration_confirm", kwargs={"code": code}),
+                )
+
+        with self.assertRaises(NoReverseMatch):
+            get_confirmation_path("a/b@example.com:x:y")
+
+    def test_reverse_once(self):
+        utils._confirmation_paths.clear()
+        with mock.patch(
+            "email_registration.utils.reverse", side_effect=reverse
+        ) as patched:
+            for i in range(3):
+                get_confirmation_url("%s@example.com" % i, "http://testserver")
+            self.assertEqual(patched.call_count, 1)
+
+            set_script_prefix("/prefix/")
+            try:
+                self.assertTrue(
+                    get_confirmation_path("code").startswith("/prefix/er/code/")
+                )
+            finally:
+                set_script_prefix("/")
+            self.assertEqual(patched.call_count, 2)
+
+            with override_settings(ROOT_URLCONF="email_registration.urls"):
+                self.assertEqual(get_confirmation_path("code"), "/code/")
+            self.assertEqual(patched.call_count, 3)
+
+    @override_settings(ROOT_URLCONF="testapp.urls_i18n")
+    def test_i18n_patterns(self):
+        for language in ["en", "de", "en"]:
+            with translation.override(language):
+                self.assertEqual(
+                    get_confirmation_path("code"), "/%s/er/code/" % language
+                )
+
+    @override_settings(ROOT_URLCONF="testapp.urls_translated")
+    def test_translated_patterns(self):
+        for language in ["en", "de", "en"]:
+            with translation.override(language):
+                self.assertEqual(
+                    get_confirmation_path("code"),
+                    reverse("email_registration_confirm", kwargs={"code": "code"}),
+                )
+        with translation.override("de"):
+            self.assertEqual(get_confirmation_path("code"), "/E-Mail-Adressecode/")
+
+    def test_site(self):
+        site = Site.objects.get_current()
+        self.assertRegex(
+            get_confirmation_url("test@example.com", site),
+            r"^https://example.com/er/test@example.com:",
+        )
+        self.assertRegex(
+            get_confirmation_url(
+                "test@example.com", RequestSite(RequestFactory().get("/"))
+            ),
+            r"^https://testserver/er/test@example.com:",
+        )
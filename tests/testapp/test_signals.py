@@ -0,0 +1,89 @@
+import threading
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.db import transaction
+from django.test import TestCase, override_settings
+
+from email_registration.signals import password_set, send_password_set
+from email_registration.utils import get_confirmation_url, send_registration_mail
+
+
+class SignalTest(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        self.received = []
+
+        def receiver(sender, user, **kwargs):
+            self.received.append((user, threading.current_thread().name))
+
+        password_set.connect(receiver)
+        self.addCleanup(password_set.disconnect, receiver)
+
+    def test_immediate(self):
+        url = get_confirmation_url("test@example.com", "http://testserver")
+        self.client.post(url, {"new_password1": "pass", "new_password2": "pass"})
+        self.assertEqual(self.received, [(User.objects.get(), "MainThread")])
+
+    @override_settings(EMAIL_REGISTRATION_ON_COMMIT=True)
+    def test_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.client.post("/er/", {"email": "test@example.com"})
+            self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+        url = get_confirmation_url("test@example.com", "http://testserver")
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.client.post(url, {"new_password1": "pass", "new_password2": "pass"})
+            self.assertEqual(self.received, [])
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(self.received), 1)
+
+    @override_settings(EMAIL_REGISTRATION_ON_COMMIT=True)
+    def test_rollback(self):
+        user = User(username="test")
+        try:
+            with transaction.atomic():
+                send_password_set(sender=User, request=None, user=user, password="x")
+                raise ValueError
+        except ValueError:
+            pass
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.received, [])
+
+    @override_settings(
+        EMAIL_REGISTRATION_ON_COMMIT=True,
+        EMAIL_REGISTRATION_WRITE_DATABASE="replica",
+    )
+    def test_on_commit_write_database(self):
+        with self.captureOnCommitCallbacks(using="replica") as callbacks:
+            send_registration_mail("test@example.com", "http://testserver")
+            send_password_set(sender=User, request=None, user=User(), password="x")
+        self.assertEqual(len(callbacks), 2)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(self.received, [])
+
+    def test_background(self):
+        def failing(sender, **kwargs):
+            raise RuntimeError("search index down")
+
+        password_set.connect(failing)
+        self.addCleanup(password_set.disconnect, failing)
+
+        url = get_confirmation_url("test@example.com", "http://testserver")
+        with self.assertLogs("email_registration.signals", "ERROR") as logs:
+            with override_settings(EMAIL_REGISTRATION_SIGNAL_WORKERS=1):
+                response = self.client.post(
+                    url, {"new_password1": "pass", "new_password2": "pass"}
+                )
+                self.assertRedirects(response, "/ac/login/")
+            # Leaving override_settings waits for the receivers
+
+        [(user, thread)] = self.received
+        self.assertEqual(user, User.objects.get())
+        self.assertTrue(thread.startswith("email-registration-signals"))
+        self.assertIn("search index down", logs.output[0])
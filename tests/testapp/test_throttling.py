@@ -0,0 +1,70 @@
+from unittest import mock
+
+from django.core import mail
+from django.test import TestCase, override_settings
+
+from email_registration.throttling import hit
+from email_registration.utils import get_cache
+
+
+class ThrottlingTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    @override_settings(EMAIL_REGISTRATION_RATE_LIMITS={"ip": (3, 60)})
+    def test_ip(self):
+        for i in range(3):
+            response = self.client.post("/er/", {"email": "%s@example.com" % i})
+            self.assertEqual(response.status_code, 200)
+
+        with self.assertNumQueries(0):
+            response = self.client.post("/er/", {"email": "3@example.com"})
+        self.assertContains(response, "Too many registration requests", status_code=429)
+        self.assertEqual(len(mail.outbox), 3)
+
+        response = self.client.post(
+            "/er/", {"email": "3@example.com"}, REMOTE_ADDR="10.0.0.1"
+        )
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(
+        EMAIL_REGISTRATION_RATE_LIMITS={"email": (2, 60)},
+        EMAIL_REGISTRATION_NORMALIZE_EMAIL="email_registration.normalization.lowercase",
+    )
+    def test_email(self):
+        for email in ["a@example.com", "A@example.com", "b@example.com"]:
+            response = self.client.post("/er/", {"email": email})
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.post("/er/", {"email": "a@example.com "})
+        self.assertEqual(response.status_code, 429)
+
+    def test_sliding_window(self):
+        with mock.patch("time.time", return_value=1000.0):
+            self.assertFalse(hit("test", "x", 2, 100))
+            self.assertFalse(hit("test", "x", 2, 100))
+            self.assertTrue(hit("test", "x", 2, 100))
+
+        # 20% of the previous window's 3 hits still count
+        with mock.patch("time.time", return_value=1180.0):
+            self.assertFalse(hit("test", "x", 2, 100))
+            self.assertTrue(hit("test", "x", 2, 100))
+
+        with mock.patch("time.time", return_value=1250.0):
+            self.assertFalse(hit("test", "x", 2, 100))
+
+    @override_settings(EMAIL_REGISTRATION_DEDUPLICATE_TIMEOUT=600)
+    def test_deduplicate(self):
+        for i in range(3):
+            response = self.client.post("/er/", {"email": "test@example.com"})
+            self.assertContains(response, "We sent you an email to test@example.com.")
+        self.assertEqual(len(mail.outbox), 1)
+
+        with mock.patch(
+            "email_registration.views.send_registration_mail",
+            side_effect=OSError,
+        ):
+            with self.assertRaises(OSError):
+                self.client.post("/er/", {"email": "other@example.com"})
+        self.client.post("/er/", {"email": "other@example.com"})
+        self.assertEqual(len(mail.outbox), 2)
@@ -0,0 +1,139 @@
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from email_registration.tokens import consume_code, get_token_store, is_consumed
+from email_registration.utils import get_cache, get_confirmation_url
+
+
+def _messages(response):
+    return [m.message for m in response.context["messages"]]
+
+
+def _consume_concurrently(code, threads=20):
+    barrier = threading.Barrier(threads)
+    results = []
+
+    def run():
+        barrier.wait()
+        results.append(consume_code(code, 60))
+
+    workers = [threading.Thread(target=run) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+@override_settings(
+    EMAIL_REGISTRATION_TOKEN_STORE="email_registration.tokens.CacheTokenStore"
+)
+class TokenStoreTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    def test_replay(self):
+        url = get_confirmation_url("test@example.com", "http://testserver")
+        response = self.client.post(
+            url, {"new_password1": "pass", "new_password2": "pass"}, follow=True
+        )
+        self.assertRedirects(response, "/ac/login/")
+        self.assertEqual(User.objects.count(), 1)
+
+        # The account exists already
+        response = self.client.get(url, follow=True)
+        self.assertEqual(_messages(response), ["The link has already been used."])
+
+        # Even if the account has been deleted meanwhile
+        User.objects.all().delete()
+        response = self.client.post(
+            url, {"new_password1": "pass", "new_password2": "pass"}, follow=True
+        )
+        self.assertEqual(_messages(response), ["The link has already been used."])
+        self.assertEqual(User.objects.count(), 0)
+
+    def test_double_submit(self):
+        url = get_confirmation_url("test@example.com", "http://testserver")
+        code = url.split("/")[-2]
+
+        # The second request has passed decode() and the existence check
+        # already when the first one consumes the code.
+        with mock.patch("email_registration.views.consume_code", return_value=False):
+            response = self.client.post(
+                url, {"new_password1": "pass", "new_password2": "pass"}, follow=True
+            )
+        self.assertEqual(_messages(response), ["The link has already been used."])
+        self.assertEqual(User.objects.count(), 0)
+        self.assertFalse(is_consumed(code))
+
+    def test_release_on_error(self):
+        url = get_confirmation_url("test@example.com", "http://testserver")
+        code = url.split("/")[-2]
+        with mock.patch(
+            "django.contrib.auth.forms.SetPasswordForm.save", side_effect=RuntimeError
+        ):
+            with self.assertRaises(RuntimeError):
+                self.client.post(
+                    url, {"new_password1": "pass", "new_password2": "pass"}
+                )
+        self.assertFalse(is_consumed(code))
+
+    def test_concurrent_locmem(self):
+        self.assertEqual(sorted(_consume_concurrently("code")), [False] * 19 + [True])
+        self.assertTrue(is_consumed("code"))
+        self.assertFalse(is_consumed("other"))
+
+    def test_concurrent_file_based(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        caches = {
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "tokens": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": location,
+            },
+        }
+        with override_settings(
+            CACHES=caches, EMAIL_REGISTRATION_TOKEN_STORE_OPTIONS={"cache": "tokens"}
+        ):
+            for i in range(5):
+                code = "code-%s" % i
+                self.assertEqual(
+                    sorted(_consume_concurrently(code)), [False] * 19 + [True]
+                )
+                self.assertTrue(is_consumed(code))
+            self.assertEqual(get_token_store().cache, "tokens")
+
+    def test_expired(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        for backend, options in [
+            ("locmem.LocMemCache", {}),
+            ("filebased.FileBasedCache", {"LOCATION": location}),
+        ]:
+            with self.subTest(backend=backend), override_settings(
+                CACHES={
+                    "default": {
+                        "BACKEND": "django.core.cache.backends.%s" % backend,
+                        **options,
+                    }
+                }
+            ), mock.patch("time.time", return_value=1000):
+                self.assertTrue(consume_code("code", 60))
+                self.assertFalse(consume_code("code", 60))
+                with mock.patch("time.time", return_value=1061):
+                    self.assertFalse(is_consumed("code"))
+                    self.assertTrue(consume_code("code", 60))
+
+
+class NoTokenStoreTest(TestCase):
+    def test_disabled(self):
+        self.assertIsNone(get_token_store())
+        self.assertTrue(consume_code("code", 60))
+        self.assertTrue(consume_code("code", 60))
+        self.assertFalse(is_consumed("code"))
@@ -3,6 +3,7 @@ from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.urls import include, path
 from django.views import generic
 
+from email_registration.urls import api_urlpatterns, async_urlpatterns
 from email_registration.views import email_registration_confirm
 
 
@@ -10,6 +11,8 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("", generic.TemplateView.as_view(template_name="base.html")),
     path("ac/", include("django.contrib.auth.urls")),
+    path("api/er/", include(api_urlpatterns)),
+    path("er-async/", include(async_urlpatterns)),
     path("er/", include("email_registration.urls")),
     path("er-quick/<str:code>/", email_registration_confirm, {"max_age": 1}),
 ] + staticfiles_urlpatterns()
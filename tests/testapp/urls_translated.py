@@ -0,0 +1,6 @@
+from django.urls import include, path
+from django.utils.translation import gettext_lazy as _
+
+
+# Translated patterns without i18n_patterns
+urlpatterns = [path(_("email address"), include("email_registration.urls"))]